@@ -1,29 +1,223 @@
 import sys
-import copy
 import time
-import intervaltree
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, func
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.attributes import set_committed_value
 
-from geenuff.base.orm import (Coordinate, Genome, Feature, Transcript, TranscriptPiece,
-    association_transcript_piece_to_feature as asso_tp_2_f, SuperLocus)
+from geenuff.base.orm import (Coordinate, Genome, Feature, Transcript, TranscriptPiece, Protein,
+    association_transcript_piece_to_feature as asso_tp_2_f,
+    association_transcript_to_protein as asso_t_2_p,
+    association_protein_to_feature as asso_p_2_f, SuperLocus, add_missing_column_views,
+    warn_about_missing_indexes)
 from geenuff.base.handlers import TranscriptHandlerBase, SuperLocusHandlerBase
 from geenuff.base.helpers import full_db_path, Counter
-from geenuff.base import types
+from geenuff.base import types, intervals
+
+
+DEFAULT_SEQUENCE_CACHE_BYTES = 2 ** 30
+# super loci loaded per round of queries, also keeps the id lists below sqlites variable limit
+DEFAULT_LOAD_BATCH_SIZE = 500
+
+
+class SequenceCache(object):
+    """Least recently used cache of whole coordinate sequences, keyed by coordinate id and
+    bounded by the total number of bases held. Sequences that alone exceed the bound are not
+    cached, their slices are fetched from the db directly instead."""
+    def __init__(self, session, max_bytes=DEFAULT_SEQUENCE_CACHE_BYTES):
+        self.session = session
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.sequences = OrderedDict()
+
+    def get_coordinate(self, coord_id):
+        return self.session.query(Coordinate).filter(Coordinate.id == coord_id).one()
+
+    def get_slice(self, coord_id, start, end):
+        start, end = max(start, 0), max(end, 0)
+        if coord_id in self.sequences:
+            self.sequences.move_to_end(coord_id)
+            return self.sequences[coord_id][start:end]
+        coordinate = self.get_coordinate(coord_id)
+        if coordinate.length > self.max_bytes:
+            return coordinate.get_slice(start, end)
+        sequence = self._add(coord_id, coordinate.get_sequence())
+        return sequence[start:end]
+
+    def _add(self, coord_id, sequence):
+        while self.sequences and self.n_bytes + len(sequence) > self.max_bytes:
+            _, evicted = self.sequences.popitem(last=False)
+            self.n_bytes -= len(evicted)
+        self.sequences[coord_id] = sequence
+        self.n_bytes += len(sequence)
+        return sequence
+
+
+class SuperLocusLoader(object):
+    """Loads the super loci with features on one coordinate, together with their transcripts,
+    pieces and features (and optionally proteins), in a few flat queries per batch. The
+    relationship collections are filled in from these results, so that walking
+    super_locus.transcripts -> transcript.transcript_pieces -> piece.features afterwards does not
+    query the db again."""
+    def __init__(self, session, batch_size=DEFAULT_LOAD_BATCH_SIZE, load_proteins=False):
+        self.session = session
+        self.batch_size = batch_size
+        self.load_proteins = load_proteins
+
+    def ordered_super_locus_ids(self, coordinate_id, among=None):
+        """super locus ids of a coordinate, minus strand first and then by their first feature. If
+        given, only those in among (a subquery of super locus ids)."""
+        query = (self.session.query(Transcript.super_locus_id)
+                    .join(TranscriptPiece, TranscriptPiece.transcript_id == Transcript.id)
+                    .join(asso_tp_2_f, asso_tp_2_f.c.transcript_piece_id == TranscriptPiece.id)
+                    .join(Feature, asso_tp_2_f.c.feature_id == Feature.id))
+        if among is None:
+            query = query.filter(Feature.coordinate_id == coordinate_id)
+        else:
+            # the '+ 0' keeps sqlite from walking the whole coordinate by its index, when the few
+            # ids in among are the selective part
+            query = (query
+                        .filter(Feature.coordinate_id + 0 == coordinate_id)
+                        .filter(Transcript.super_locus_id.in_(among)))
+        query = (query
+                    .group_by(Transcript.super_locus_id)
+                    .order_by(func.min(Feature.is_plus_strand))
+                    .order_by(func.min(Feature.start))
+                    .order_by(Transcript.super_locus_id))
+        return [r[0] for r in query.all()]
+
+    def gen_batches(self, coordinate_id):
+        """yields lists of fully loaded super loci of a coordinate, in export order"""
+        ordered_ids = self.ordered_super_locus_ids(coordinate_id)
+        for i in range(0, len(ordered_ids), self.batch_size):
+            yield self.load_super_loci(ordered_ids[i:(i + self.batch_size)])
+
+    def load(self, coordinate_id):
+        """returns all fully loaded super loci of a coordinate in export order"""
+        return [sl for batch in self.gen_batches(coordinate_id) for sl in batch]
+
+    def load_super_loci(self, sl_ids):
+        """loads the super loci of sl_ids and everything below them, returned in the order of sl_ids"""
+        transcript_ids = (self.session.query(Transcript.id)
+                             .filter(Transcript.super_locus_id.in_(sl_ids))
+                             .subquery())
+        piece_ids = (self.session.query(TranscriptPiece.id)
+                        .filter(TranscriptPiece.transcript_id.in_(transcript_ids))
+                        .subquery())
+
+        super_loci = {sl.id: sl for sl in
+                      self.session.query(SuperLocus).filter(SuperLocus.id.in_(sl_ids)).all()}
+        transcripts = (self.session.query(Transcript)
+                          .filter(Transcript.super_locus_id.in_(sl_ids))
+                          .order_by(Transcript.id)
+                          .all())
+        pieces = (self.session.query(TranscriptPiece)
+                     .filter(TranscriptPiece.transcript_id.in_(transcript_ids))
+                     .order_by(TranscriptPiece.id)
+                     .all())
+        piece_feature_pairs = (self.session.query(asso_tp_2_f.c.transcript_piece_id, Feature)
+                                  .join(Feature, Feature.id == asso_tp_2_f.c.feature_id)
+                                  .filter(asso_tp_2_f.c.transcript_piece_id.in_(piece_ids))
+                                  .order_by(Feature.id)
+                                  .all())
+        self._assemble(super_loci, transcripts, pieces, piece_feature_pairs)
+        if self.load_proteins:
+            self._load_proteins(sl_ids, super_loci, transcripts, transcript_ids,
+                                [feature for _, feature in piece_feature_pairs])
+        return [super_loci[sl_id] for sl_id in sl_ids]
+
+    @staticmethod
+    def _assemble(super_loci, transcripts, pieces, piece_feature_pairs):
+        pieces_by_id = {p.id: p for p in pieces}
+        transcripts_by_sl = defaultdict(list)
+        for transcript in transcripts:
+            transcripts_by_sl[transcript.super_locus_id].append(transcript)
+            set_committed_value(transcript, 'super_locus', super_loci[transcript.super_locus_id])
+        pieces_by_transcript = defaultdict(list)
+        for piece in pieces:
+            pieces_by_transcript[piece.transcript_id].append(piece)
+        features_by_piece = defaultdict(list)
+        pieces_by_feature = defaultdict(list)
+        for piece_id, feature in piece_feature_pairs:
+            features_by_piece[piece_id].append(feature)
+            pieces_by_feature[feature].append(pieces_by_id[piece_id])
+
+        for sl_id, super_locus in super_loci.items():
+            set_committed_value(super_locus, 'transcripts', transcripts_by_sl[sl_id])
+        for transcript in transcripts:
+            set_committed_value(transcript, 'transcript_pieces', pieces_by_transcript[transcript.id])
+            for piece in pieces_by_transcript[transcript.id]:
+                set_committed_value(piece, 'transcript', transcript)
+        for piece in pieces:
+            set_committed_value(piece, 'features', features_by_piece[piece.id])
+        for feature, feature_pieces in pieces_by_feature.items():
+            set_committed_value(feature, 'transcript_pieces', feature_pieces)
+
+    def _load_proteins(self, sl_ids, super_loci, transcripts, transcript_ids, features):
+        proteins = (self.session.query(Protein)
+                       .filter(Protein.super_locus_id.in_(sl_ids))
+                       .order_by(Protein.id)
+                       .all())
+        proteins_by_id = {p.id: p for p in proteins}
+        protein_ids = (self.session.query(Protein.id)
+                          .filter(Protein.super_locus_id.in_(sl_ids))
+                          .subquery())
+        transcript_protein_pairs = (self.session.query(asso_t_2_p.c.transcript_id,
+                                                       asso_t_2_p.c.protein_id)
+                                       .filter(asso_t_2_p.c.transcript_id.in_(transcript_ids))
+                                       .all())
+        protein_feature_pairs = (self.session.query(asso_p_2_f.c.protein_id, Feature)
+                                    .join(Feature, Feature.id == asso_p_2_f.c.feature_id)
+                                    .filter(asso_p_2_f.c.protein_id.in_(protein_ids))
+                                    .order_by(Feature.id)
+                                    .all())
+        transcripts_by_id = {t.id: t for t in transcripts}
+
+        proteins_by_sl = defaultdict(list)
+        for protein in proteins:
+            proteins_by_sl[protein.super_locus_id].append(protein)
+            set_committed_value(protein, 'super_locus', super_loci[protein.super_locus_id])
+        proteins_by_transcript = defaultdict(list)
+        transcripts_by_protein = defaultdict(list)
+        for transcript_id, protein_id in transcript_protein_pairs:
+            proteins_by_transcript[transcript_id].append(proteins_by_id[protein_id])
+            transcripts_by_protein[protein_id].append(transcripts_by_id[transcript_id])
+        features_by_protein = defaultdict(list)
+        proteins_by_feature = defaultdict(list)
+        for protein_id, feature in protein_feature_pairs:
+            features_by_protein[protein_id].append(feature)
+            proteins_by_feature[feature].append(proteins_by_id[protein_id])
+
+        for sl_id, super_locus in super_loci.items():
+            set_committed_value(super_locus, 'proteins', proteins_by_sl[sl_id])
+        for transcript in transcripts:
+            set_committed_value(transcript, 'proteins', proteins_by_transcript[transcript.id])
+        for protein in proteins:
+            set_committed_value(protein, 'transcripts', transcripts_by_protein[protein.id])
+            set_committed_value(protein, 'features', features_by_protein[protein.id])
+        for feature in set(features) | set(proteins_by_feature):
+            set_committed_value(feature, 'proteins', proteins_by_feature[feature])
 
 
 class GeenuffExportController(object):
-    def __init__(self, db_path_in, longest=False):
+    # whether the exporter needs the proteins of its super loci
+    load_proteins = False
+    load_batch_size = DEFAULT_LOAD_BATCH_SIZE
+
+    def __init__(self, db_path_in, longest=False, sequence_cache_bytes=DEFAULT_SEQUENCE_CACHE_BYTES):
         self.db_path_in = db_path_in
         self._mk_session()
         self.longest = longest
         self.id_counter = Counter()
         self.export_ranges = []
+        # shared by all exporters that need sequence
+        self.sequence_cache = SequenceCache(self.session, sequence_cache_bytes)
 
     def _mk_session(self):
         self.engine = create_engine(full_db_path(self.db_path_in), echo=False)
+        event.listen(self.engine, 'connect', add_missing_column_views)
+        warn_about_missing_indexes(self.engine)
         self.session = sessionmaker(bind=self.engine)()
 
     def get_coord_by_id(self, coord_id):
@@ -43,28 +237,7 @@ class GeenuffExportController(object):
     def _all_coords_query(self):
         return self.session.query(Coordinate.id)
 
-    def genome_query(self, genomes, exclude, return_super_loci=False):
-        """Returns either a tuple of (super_loci, coordinate_seqid) or a dict of coord_ids grouped by
-        their genome that each link to a list of features. If return_super_loci is False, only the
-        features of the longest transcript are queried."""
-        self._check_genome_names(genomes, exclude)
-        if return_super_loci:
-            query = (self.session.query(SuperLocus, Coordinate.seqid).distinct()
-                        .join(Transcript, Transcript.super_locus_id == SuperLocus.id)
-                        .join(TranscriptPiece, TranscriptPiece.transcript_id == Transcript.id)
-                        .join(asso_tp_2_f, asso_tp_2_f.c.transcript_piece_id == TranscriptPiece.id)
-                        .join(Feature, asso_tp_2_f.c.feature_id == Feature.id)
-                        .join(Coordinate, Feature.coordinate_id == Coordinate.id)
-                        .join(Genome, Genome.id == Coordinate.genome_id))
-        else:
-            query = (self.session.query(Feature, Coordinate.id, Coordinate.length, Coordinate.genome_id)
-                        .join(Coordinate, Feature.coordinate_id == Coordinate.id)
-                        .join(asso_tp_2_f, asso_tp_2_f.c.feature_id == Feature.id)
-                        .join(TranscriptPiece, asso_tp_2_f.c.transcript_piece_id == TranscriptPiece.id)
-                        .join(Transcript, TranscriptPiece.transcript_id == Transcript.id)
-                        .join(Genome, Genome.id == Coordinate.genome_id)
-                        .filter(Transcript.longest == True))
-
+    def _filter_genomes(self, query, genomes, exclude):
         if genomes:
             print('Selecting the following genomes: {}'.format(genomes), file=sys.stderr)
             query = query.filter(Genome.species.in_(genomes))
@@ -75,48 +248,78 @@ class GeenuffExportController(object):
                 query = query.filter(Genome.species.notin_(exclude))
             else:
                 print('Selecting all genomes from {}'.format(self.db_path_in), file=sys.stderr)
+        return query
+
+    def coordinates_query(self, genomes, exclude):
+        """(id, seqid) of all selected coordinates, ordered so that the larger ones come first"""
+        query = (self.session.query(Coordinate.id, Coordinate.seqid)
+                    .join(Genome, Genome.id == Coordinate.genome_id))
+        query = self._filter_genomes(query, genomes, exclude)
+        return (query
+                   .order_by(Genome.species)
+                   .order_by(Coordinate.length.desc())
+                   .order_by(Coordinate.id))
+
+    def gen_super_loci(self, genomes, exclude):
+        """yields (super_locus, coordinate_seqid) coordinate by coordinate, with each super locus
+        fully loaded by the SuperLocusLoader"""
+        self._check_genome_names(genomes, exclude)
+        loader = SuperLocusLoader(self.session, batch_size=self.load_batch_size,
+                                  load_proteins=self.load_proteins)
+        # keep all super loci of one coordinate together, so each sequence is needed in one go
+        for coordinate_id, seqid in self.coordinates_query(genomes, exclude).all():
+            for batch in loader.gen_batches(coordinate_id):
+                for super_locus in batch:
+                    yield super_locus, seqid
 
+    def genome_query(self, genomes, exclude, return_super_loci=False):
+        """Returns either a list of (super_locus, coordinate_seqid) or a dict of coord_ids grouped by
+        their genome that each link to a list of features. If return_super_loci is False, only the
+        features of the longest transcript are queried."""
         if return_super_loci:
-            query = (query
-                        .order_by(Genome.species)
-                        .order_by(Coordinate.length.desc())
-                        .order_by(Feature.is_plus_strand)
-                        .order_by(Feature.start))
-            return query.all()
-        else:
-            print('Querying all relevant features...')
-            start = time.time()
-            regular_features = (query
-                                   .order_by(Genome.species)
-                                   .order_by(Coordinate.length.desc())
-                                   .all())
-            regular_time = time.time()
-            print('Query for regular features took {:.2f}s'.format(regular_time - start))
-            # also getting the errors, which are not linked to a Transcript
-            error_type_values = [t.value for t in types.Errors]
-            error_features_query = (self.session.query(Feature, Coordinate.id, Coordinate.length,
-                                                       Coordinate.genome_id)
-                                       .join(Coordinate, Feature.coordinate_id == Coordinate.id)
-                                       .join(Genome, Genome.id == Coordinate.genome_id)
-                                       .filter(Feature.type.in_(error_type_values)))
-            if genomes:
-                error_features_query = error_features_query.filter(Genome.species.in_(genomes))
-            elif exclude:
-                error_features_query = error_features_query.filter(Genome.species.notin_(genomes))
-            error_features = error_features_query.all()
-            print('Query for error features took {:.2f}s'.format(time.time() - regular_time))
-
-            all_coords_with_features = regular_features + error_features
-            genome_coord_features = defaultdict(lambda: defaultdict(list))
-            for feature, coord_id, coord_len, genome_id in all_coords_with_features:
-                genome_coord_features[genome_id][(coord_id, coord_len)].append(feature)
-            return genome_coord_features
+            return list(self.gen_super_loci(genomes, exclude))
+
+        self._check_genome_names(genomes, exclude)
+        query = (self.session.query(Feature, Coordinate.id, Coordinate.length, Coordinate.genome_id)
+                    .join(Coordinate, Feature.coordinate_id == Coordinate.id)
+                    .join(asso_tp_2_f, asso_tp_2_f.c.feature_id == Feature.id)
+                    .join(TranscriptPiece, asso_tp_2_f.c.transcript_piece_id == TranscriptPiece.id)
+                    .join(Transcript, TranscriptPiece.transcript_id == Transcript.id)
+                    .join(Genome, Genome.id == Coordinate.genome_id)
+                    .filter(Transcript.longest == True))
+        query = self._filter_genomes(query, genomes, exclude)
+
+        print('Querying all relevant features...')
+        start = time.time()
+        regular_features = (query
+                               .order_by(Genome.species)
+                               .order_by(Coordinate.length.desc())
+                               .all())
+        regular_time = time.time()
+        print('Query for regular features took {:.2f}s'.format(regular_time - start))
+        # also getting the errors, which are not linked to a Transcript
+        error_type_values = [t.value for t in types.Errors]
+        error_features_query = (self.session.query(Feature, Coordinate.id, Coordinate.length,
+                                                   Coordinate.genome_id)
+                                   .join(Coordinate, Feature.coordinate_id == Coordinate.id)
+                                   .join(Genome, Genome.id == Coordinate.genome_id)
+                                   .filter(Feature.type.in_(error_type_values)))
+        if genomes:
+            error_features_query = error_features_query.filter(Genome.species.in_(genomes))
+        elif exclude:
+            error_features_query = error_features_query.filter(Genome.species.notin_(genomes))
+        error_features = error_features_query.all()
+        print('Query for error features took {:.2f}s'.format(time.time() - regular_time))
+
+        all_coords_with_features = regular_features + error_features
+        genome_coord_features = defaultdict(lambda: defaultdict(list))
+        for feature, coord_id, coord_len, genome_id in all_coords_with_features:
+            genome_coord_features[genome_id][(coord_id, coord_len)].append(feature)
+        return genome_coord_features
 
     def gen_ranges(self, genomes, exclude, range_function):
-        super_loci = [r[0] for r in self.genome_query(genomes, exclude, return_super_loci=True)]
-        for super_locus in super_loci:
+        for super_locus, _ in self.gen_super_loci(genomes, exclude):
             sl_ranger = SuperLocusRanger(super_locus, longest=self.longest)
-            # todo, once JOIN output exists, drop all these loops
             for range_maker in sl_ranger.exp_range_makers:
                 export_groups = range_function(range_maker)
                 for group in export_groups:
@@ -200,61 +403,74 @@ class ExportGroup(object):
 class RangeMaker(TranscriptHandlerBase):
     """Interprets a transcript as ordered flattened ranges from its features"""
 
+    def __init__(self, data=None):
+        # ranges by type and derived ranges are computed at most once, see invalidate_cache
+        self._cache = {}
+        super().__init__(data)
+
+    def add_data(self, data):
+        super().add_data(data)
+        self.invalidate_cache()
+
+    def invalidate_cache(self):
+        """forget all memoized ranges, required if the features of the transcript change"""
+        self._cache = {}
+
+    def _memoized(self, key, make_ranges):
+        if key not in self._cache:
+            self._cache[key] = make_ranges()
+        # a copy, so that the cached list can't be changed from outside
+        return list(self._cache[key])
+
     def feature_piece_pairs(self):
         for piece in self.data.transcript_pieces:
             for feature in piece.features:
                 yield feature, piece
 
-    # helpers for classic transitions below
-    def _ranges_by_type(self, target_type):
-        ranges = []
+    def _ranges_by_all_types(self):
+        ranges = defaultdict(list)
         for feature, piece in self.feature_piece_pairs():
-            if feature.type.value == target_type:  # and 0 is simply ignored...
-                ranges.append(Range(coordinate_id=feature.coordinate_id,
-                                    start=feature.start,
-                                    end=feature.end,
-                                    is_plus_strand=feature.is_plus_strand,
-                                    piece_position=piece.position,
-                                    given_name=feature.given_name))
-
+            ranges[feature.type.value].append(Range(coordinate_id=feature.coordinate_id,
+                                                    start=feature.start,
+                                                    end=feature.end,
+                                                    is_plus_strand=feature.is_plus_strand,
+                                                    piece_position=piece.position,
+                                                    given_name=feature.given_name))
         return ranges
 
-    @staticmethod
-    def _make_trees(ranges):
-        trees = {}
-        for r in ranges:
-            coord_isplus = r.sequence_chunk_info()
-            if coord_isplus not in trees:
-                trees[coord_isplus] = intervaltree.IntervalTree()
-            # todo, is that sufficient, do we not need to add one to -strand coordinates?
-            start, end = min(r.start, r.end), max(r.start, r.end)
-            trees[coord_isplus][start:end] = r
-        return trees
+    # helpers for classic transitions below
+    def _ranges_by_type(self, target_type):
+        if 'by_type' not in self._cache:
+            self._cache['by_type'] = self._ranges_by_all_types()
+        return list(self._cache['by_type'].get(target_type, []))
 
     @staticmethod
-    def _copy_ival_data(iv, islower):
-        if islower:  # copy one of the two sides so that we don't change the same dictionary later
-            out = copy.deepcopy(iv.data)
-        else:
-            out = iv.data
-        return out
+    def _as_intervals(ranges, groups):
+        """ranges as (group, lower, upper), with one group per (coordinate, piece position, strand)"""
+        # todo, is that sufficient, do we not need to add one to -strand coordinates?
+        return [(groups.setdefault(r.sequence_chunk_info(), len(groups)), min(r.start, r.end),
+                 max(r.start, r.end)) for r in ranges]
 
     def _subtract_ranges(self, subtract_from, to_subtract):
-        keep_trees = self._make_trees(subtract_from)
-        subtract_trees = self._make_trees(to_subtract)
-        if not subtract_trees:
+        """the parts of subtract_from not covered by to_subtract, as new Ranges"""
+        if not to_subtract:
             return self._resort_subtracted(subtract_from)
+        groups = {}
+        keep = self._as_intervals(subtract_from, groups)
+        chop_out = self._as_intervals(to_subtract, groups)
         subtracted = []
-        for key in keep_trees:
-            for chop_out in subtract_trees[key]:
-                keep_trees[key].chop(chop_out.begin, chop_out.end, self._copy_ival_data)
-            for kept in keep_trees[key]:
-                start, end = kept.begin, kept.end
-                if not kept.data.is_plus_strand:
-                    start, end = end, start
-                kept.data.start = start
-                kept.data.end = end
-                subtracted.append(kept.data)
+        for source, _, lower, upper in intervals.subtract(keep, chop_out):
+            kept = subtract_from[source]
+            if kept.is_plus_strand:
+                start, end = lower, upper
+            else:
+                start, end = upper, lower
+            subtracted.append(Range(coordinate_id=kept.coordinate_id,
+                                    piece_position=kept.piece_position,
+                                    start=start,
+                                    end=end,
+                                    is_plus_strand=kept.is_plus_strand,
+                                    given_name=kept.given_name))
         return self._resort_subtracted(subtracted)
 
     @staticmethod
@@ -278,26 +494,27 @@ class RangeMaker(TranscriptHandlerBase):
     def intronic_ranges(self):
         return self._one_range_one_group(self._ranges_by_type(types.GEENUFF_INTRON))
 
+    def _exons(self):
+        return self._memoized('exons', lambda: self._subtract_ranges(
+            subtract_from=self._ranges_by_type(types.GEENUFF_TRANSCRIPT),
+            to_subtract=self._ranges_by_type(types.GEENUFF_INTRON)))
+
     def exonic_ranges(self):  # AKA exon
-        transcribeds = self._ranges_by_type(types.GEENUFF_TRANSCRIPT)
-        introns = self._ranges_by_type(types.GEENUFF_INTRON)
-        print(introns)
-        exons = self._subtract_ranges(subtract_from=transcribeds, to_subtract=introns)
-        return self._one_range_one_group(exons)
+        return self._one_range_one_group(self._exons())
 
     def cds_exonic_ranges(self):  # AKA CDS
         # todo, somewhere, maybe not here, consider further consistency checking
         #  e.g. (that all CODING regions are within TRANSCRIBED regions)
         # todo, return separately if CDS features are connected to different proteins
-        geenuff_cds = self._ranges_by_type(types.GEENUFF_CDS)
-        introns = self._ranges_by_type(types.GEENUFF_INTRON)
-        coding_exons = self._subtract_ranges(subtract_from=geenuff_cds, to_subtract=introns)
+        coding_exons = self._memoized('coding_exons', lambda: self._subtract_ranges(
+            subtract_from=self._ranges_by_type(types.GEENUFF_CDS),
+            to_subtract=self._ranges_by_type(types.GEENUFF_INTRON)))
         return self._one_range_one_group(coding_exons)
 
     def untranslated_exonic_ranges(self):  # AKA UTR
-        exons = self.exonic_ranges()
-        geenuff_cds = self._ranges_by_type(types.GEENUFF_CDS)
-        utrs = self._subtract_ranges(subtract_from=exons, to_subtract=geenuff_cds)
+        utrs = self._memoized('utrs', lambda: self._subtract_ranges(
+            subtract_from=self._exons(),
+            to_subtract=self._ranges_by_type(types.GEENUFF_CDS)))
         return self._one_range_one_group(utrs)
 
     def mature_RNA(self):
@@ -419,8 +636,13 @@ class SuperLocusRanger(SuperLocusHandlerBase):
     def get_longest_transcript(self):
         """identify which transcript in this super locus is longest (with introns removed)"""
         transcript, length = None, 0
+        # use the lengths from import, unless some are missing
+        precomputed = all(rm.data.mature_length is not None for rm in self.range_makers)
         for range_maker in self.range_makers:
-            rm_length = range_maker.sum_exonic_lengths()
+            if precomputed:
+                rm_length = range_maker.data.mature_length
+            else:
+                rm_length = range_maker.sum_exonic_lengths()
             if rm_length > length:
                 transcript = range_maker
                 length = rm_length
@@ -1,38 +1,151 @@
 import sys
 import json
 from abc import ABC, abstractmethod
-from geenuff.applications.exporter import GeenuffExportController
+from operator import attrgetter
+
+from geenuff.applications.exporter import (GeenuffExportController, SuperLocusLoader,
+                                           DEFAULT_SEQUENCE_CACHE_BYTES)
 from geenuff.base.handlers import SuperLocusHandlerBase, TranscriptHandlerBase, CoordinateHandlerBase, \
     FeatureHandlerBase
 
-from geenuff.base.orm import Coordinate, Transcript, SuperLocus
+from geenuff.base.orm import (Coordinate, Genome, Transcript, TranscriptPiece, SuperLocus,
+    association_transcript_piece_to_feature as asso_tp_2_f, feature_rtree, has_feature_rtree)
 from geenuff.base.helpers import reverse_complement, chunk_str
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _json_dumps(obj):
+    return json.dumps(obj).encode()
+
+
+def json_dumper(use_orjson=None):
+    """function serializing to json bytes, with orjson if available (or asked for)"""
+    if use_orjson is None:
+        use_orjson = orjson is not None
+    if use_orjson:
+        if orjson is None:
+            raise ImportError('orjson was requested, but is not installed')
+        return orjson.dumps
+    return _json_dumps
+
+
+_attr_getters = {}
+_enum_values = {}
+
+
+def attr_getter(keys):
+    """one attrgetter per set of keys, returning a tuple of the attributes"""
+    keys = tuple(keys)
+    if keys not in _attr_getters:
+        getter = attrgetter(*keys)
+        if len(keys) == 1:
+            # attrgetter returns the attribute itself for a single key
+            _attr_getters[keys] = lambda obj: (getter(obj),)
+        else:
+            _attr_getters[keys] = getter
+    return _attr_getters[keys]
+
+
+def enum_value(member):
+    try:
+        return _enum_values[member]
+    except KeyError:
+        _enum_values[member] = member.value
+        return member.value
+
 
 class ToJsonable(object):
 
     def __init__(self):
         self.jsonable_keys = ["id", "given_name"]
+        self._spans = None
+        self._window = None
+        self._window_checks = None
+
+    @property
+    def spans(self):
+        """{(coordinate_id, is_plus_strand): [min start, max start, min end, max end]} over all
+        features below, calculated once"""
+        if self._spans is None:
+            self._spans = self._mk_spans()
+        return self._spans
 
     @abstractmethod
-    def is_fully_contained(self, coordinate, start, end, is_plus_strand):
+    def _mk_spans(self):
         pass
 
     @abstractmethod
-    def overlaps(self, coordinate, start, end, is_plus_strand):
+    def _overlaps_exactly(self, coordinate, start, end, is_plus_strand):
         pass
 
+    def is_fully_contained(self, coordinate, start, end, is_plus_strand):
+        return self.window_checks(coordinate, start, end, is_plus_strand)[0]
+
+    def overlaps(self, coordinate, start, end, is_plus_strand):
+        return self.window_checks(coordinate, start, end, is_plus_strand)[1]
+
+    def window_checks(self, coordinate, start, end, is_plus_strand):
+        """(is_fully_contained, overlaps), calculated once for the last window asked for"""
+        window = (coordinate.id, start, end, is_plus_strand)
+        if window != self._window:
+            self._window_checks = self._check_window(coordinate, start, end, is_plus_strand)
+            self._window = window
+        return self._window_checks
+
+    def _check_window(self, coordinate, start, end, is_plus_strand):
+        if not self.spans:
+            # nothing below, as all([]) and any([])
+            return True, False
+        span = self.spans.get((coordinate.id, is_plus_strand))
+        if span is None or not span_touches(span, start, end):
+            return False, False
+        is_fully_contained = len(self.spans) == 1 and span_is_contained(span, start, end,
+                                                                        is_plus_strand)
+        # containment implies overlap, only otherwise do the parts below have to be checked
+        overlaps = is_fully_contained or self._overlaps_exactly(coordinate, start, end,
+                                                                is_plus_strand)
+        return is_fully_contained, overlaps
+
     def pre_to_jsonable(self, data):
-        out = {}
-        for key in self.jsonable_keys:
-            out[key] = data.__getattribute__(key)
-        return out
+        return dict(zip(self.jsonable_keys, attr_getter(self.jsonable_keys)(data)))
 
     @abstractmethod
     def to_jsonable(self, data, coordinate, start, end, is_plus_strand):
         pass
 
 
+def merge_spans(all_spans):
+    out = {}
+    for spans in all_spans:
+        for key, span in spans.items():
+            if key in out:
+                s0, s1, e0, e1 = out[key]
+                out[key] = [min(s0, span[0]), max(s1, span[1]), min(e0, span[2]), max(e1, span[3])]
+            else:
+                out[key] = list(span)
+    return out
+
+
+def span_touches(span, start, end):
+    """whether any start or end in the span could overlap the window (a quick, inclusive check)"""
+    min_start, max_start, min_end, max_end = span
+    return (min(min_start, min_end) <= max(start, end)
+            and max(max_start, max_end) >= min(start, end))
+
+
+def span_is_contained(span, start, end, is_plus_strand):
+    """whether every feature summarized in span is fully contained in the window"""
+    min_start, max_start, min_end, max_end = span
+    if is_plus_strand:
+        return start <= min_start and max_start < end and start < min_end and max_end <= end
+    else:
+        return start >= max_start and min_start > end and start > max_end and min_end >= end
+
+
 # then multi inheritance of above and Handlers
 class FeatureJsonable(FeatureHandlerBase, ToJsonable):
     def __init__(self, data=None):
@@ -40,14 +153,20 @@ class FeatureJsonable(FeatureHandlerBase, ToJsonable):
         ToJsonable.__init__(self)
         self.jsonable_keys += ["start", "start_is_biological_start", "end", "end_is_biological_end",
                                "is_plus_strand", "score", "source", "phase"]
+        # everything but the window dependent values, to be reused for every window
+        self._jsonable = None
 
     def to_jsonable(self, data, coordinate, start, end, is_plus_strand, transcript=None):
         assert transcript is not None, "needed to get the protein id"
-        out = self.pre_to_jsonable(self.data)
-        out['type'] = data.type.value
-        out['is_fully_contained'] = self.is_fully_contained(coordinate, start, end, is_plus_strand)
-        out['overlaps'] = self.overlaps(coordinate, start, end, is_plus_strand)
-        out['protein_id'] = self.protein_ids(transcript)
+        if self._jsonable is None:
+            out = self.pre_to_jsonable(self.data)
+            out['type'] = enum_value(data.type)
+            out['is_fully_contained'] = out['overlaps'] = None
+            out['protein_id'] = self.protein_ids(transcript)
+            self._jsonable = out
+        out = dict(self._jsonable)
+        out['is_fully_contained'], out['overlaps'] = self.window_checks(coordinate, start, end,
+                                                                        is_plus_strand)
         return out
 
     def protein_ids(self,  transcript):
@@ -64,39 +183,25 @@ class FeatureJsonable(FeatureHandlerBase, ToJsonable):
             # todo, actually, I don't think this should be able to happen, but double check
             raise NotImplementedError("what to do with {} proteins?".format(len(p_ids)))
 
-    def is_fully_contained(self, coordinate, start, end, is_plus_strand):
-        if coordinate.id != self.data.coordinate_id or is_plus_strand != self.data.is_plus_strand:
-            return False
-        else:
-            if is_plus_strand:
-                if start <= self.data.start < end and start < self.data.end <= end:
-                    return True
-                else:
-                    return False
-            else:
-                if start >= self.data.start > end and start > self.data.end >= end:
-                    return True
-                else:
-                    return False
+    def _mk_spans(self):
+        return {(self.data.coordinate_id, self.data.is_plus_strand):
+                [self.data.start, self.data.start, self.data.end, self.data.end]}
 
-    def overlaps(self, coordinate, start, end, is_plus_strand):
-        if coordinate.id != self.data.coordinate_id or is_plus_strand != self.data.is_plus_strand:
-            return False
+    def _overlaps_exactly(self, coordinate, start, end, is_plus_strand):
+        if is_plus_strand:
+            if start <= self.data.start < end or start < self.data.end <= end:
+                return True
+            elif self.data.start <= start < self.data.end or self.data.start < end <= self.data.end:
+                return True
+            else:
+                return False
         else:
-            if is_plus_strand:
-                if start <= self.data.start < end or start < self.data.end <= end:
-                    return True
-                elif self.data.start <= start < self.data.end or self.data.start < end <= self.data.end:
-                    return True
-                else:
-                    return False
+            if start >= self.data.start > end or start > self.data.end >= end:
+                return True
+            elif self.data.start >= start > self.data.end or self.data.start > end >= self.data.end:
+                return True
             else:
-                if start >= self.data.start > end or start > self.data.end >= end:
-                    return True
-                elif self.data.start >= start > self.data.end or self.data.start > end >= self.data.end:
-                    return True
-                else:
-                    return False
+                return False
 
 
 class TranscriptJsonable(TranscriptHandlerBase, ToJsonable):
@@ -119,24 +224,17 @@ class TranscriptJsonable(TranscriptHandlerBase, ToJsonable):
             out += features
         return out
 
-    # todo, use pre-calculated jsons not fresh method call
-    def overlaps(self, coordinate, start, end, is_plus_strand):
-        if any([fh.overlaps(coordinate, start, end, is_plus_strand) for fh in self.feature_handlers]):
-            return True
-        else:
-            return False
+    def _mk_spans(self):
+        return merge_spans(fh.spans for fh in self.feature_handlers)
 
-    def is_fully_contained(self, coordinate, start, end, is_plus_strand):
-        if all([fh.is_fully_contained(coordinate, start, end, is_plus_strand) for fh in self.feature_handlers]):
-            return True
-        else:
-            return False
+    def _overlaps_exactly(self, coordinate, start, end, is_plus_strand):
+        return any(fh.overlaps(coordinate, start, end, is_plus_strand) for fh in self.feature_handlers)
 
     def to_jsonable(self, data, coordinate, start, end, is_plus_strand):
         out = self.pre_to_jsonable(self.data)
-        out["type"] = self.data.type.value
-        out["is_fully_contained"] = self.is_fully_contained(coordinate, start, end, is_plus_strand)
-        out["overlaps"] = self.overlaps(coordinate, start, end, is_plus_strand)
+        out["type"] = enum_value(self.data.type)
+        out["is_fully_contained"], out["overlaps"] = self.window_checks(coordinate, start, end,
+                                                                        is_plus_strand)
         out["features"] = [fh.to_jsonable(fh.data, coordinate, start, end, is_plus_strand, self.data)
                            for fh in self.feature_handlers]
         return out
@@ -144,7 +242,6 @@ class TranscriptJsonable(TranscriptHandlerBase, ToJsonable):
 
 class SuperLocusJsonable(SuperLocusHandlerBase, ToJsonable):
     def __init__(self, data=None):
-        print(type(data))
         FeatureHandlerBase.__init__(self, data)
         ToJsonable.__init__(self)
         self.transcript_handlers = self._mk_transcript_handlers()
@@ -152,33 +249,40 @@ class SuperLocusJsonable(SuperLocusHandlerBase, ToJsonable):
     def _mk_transcript_handlers(self):
         return [TranscriptJsonable(x) for x in self.data.transcripts]
 
-    def is_fully_contained(self, coordinate, start, end, is_plus_strand):
-        if all([th.is_fully_contained(coordinate, start, end, is_plus_strand) for th in self.transcript_handlers]):
-            return True
-        else:
-            return False
+    def _mk_spans(self):
+        return merge_spans(th.spans for th in self.transcript_handlers)
 
-    def overlaps(self, coordinate, start, end, is_plus_strand):
-        if any([th.overlaps(coordinate, start, end, is_plus_strand) for th in self.transcript_handlers]):
-            return True
-        else:
-            return False
+    def _overlaps_exactly(self, coordinate, start, end, is_plus_strand):
+        return any(th.overlaps(coordinate, start, end, is_plus_strand)
+                   for th in self.transcript_handlers)
 
     def to_jsonable(self, data, coordinate, start, end, is_plus_strand):
         out = self.pre_to_jsonable(self.data)
-        out['type'] = self.data.type.value
-        out['is_fully_contained'] = self.is_fully_contained(coordinate, start, end, is_plus_strand)
-        out['overlaps'] = self.overlaps(coordinate, start, end, is_plus_strand)
+        out['type'] = enum_value(self.data.type)
+        out['is_fully_contained'], out['overlaps'] = self.window_checks(coordinate, start, end,
+                                                                        is_plus_strand)
         out['transcripts'] = [th.to_jsonable(th, coordinate, start, end, is_plus_strand)
                               for th in self.transcript_handlers]
         return out
 
+    def all_window_checks(self, coordinate, start, end, is_plus_strand):
+        """the window checks of the super locus and of every transcript and feature below, i.e.
+        everything its jsonable depends on besides the data"""
+        window = (coordinate, start, end, is_plus_strand)
+        return (self.window_checks(*window),) + tuple(
+            (th.window_checks(*window), tuple(fh.window_checks(*window) for fh in th.feature_handlers))
+            for th in self.transcript_handlers)
+
 
 class CoordinateJsonable(CoordinateHandlerBase):
-    def to_jsonable(self, start, end):
+    def to_jsonable(self, start, end, sequence_cache=None):
+        if sequence_cache is None:
+            sequence = self.data.get_slice(start, end)
+        else:
+            sequence = sequence_cache.get_slice(self.data.id, start, end)
         return {'id': self.data.id,
                 'seqid': self.data.seqid,
-                'sequence': self.data.sequence[start:end],
+                'sequence': sequence,
                 'start': start,
                 'end': end}
 
@@ -186,26 +290,113 @@ class CoordinateJsonable(CoordinateHandlerBase):
 class JsonExportController(GeenuffExportController):
     # todo, filter coordinate by start, end
     #  from orm obj (or join res) to json
+    load_proteins = True
+
+    def __init__(self, db_path_in, longest=False, sequence_cache_bytes=DEFAULT_SEQUENCE_CACHE_BYTES):
+        super().__init__(db_path_in, longest, sequence_cache_bytes)
+        self.loader = SuperLocusLoader(self.session, batch_size=self.load_batch_size,
+                                       load_proteins=self.load_proteins)
+        self._has_feature_index = None
+
+    @property
+    def has_feature_index(self):
+        if self._has_feature_index is None:
+            self._has_feature_index = has_feature_rtree(self.engine)
+        return self._has_feature_index
+
+    def get_coordinates(self, species, seqid):
+        return (self.session.query(Coordinate)
+                   .join(Genome, Genome.id == Coordinate.genome_id)
+                   .filter(Genome.species == species)
+                   .filter(Coordinate.seqid == seqid)
+                   .all())
+
+    def overlapping_super_locus_ids(self, coordinate, start, end, is_plus_strand):
+        """ids of the super loci with features in the window, according to the feature index.
+        The index bounds are inclusive, so this is a (close) superset of the overlapping ones.
+        They are in the order the super loci of a coordinate are exported in without the index."""
+        lower, upper = min(start, end), max(start, end)
+        in_window = (self.session.query(Transcript.super_locus_id)
+                    .select_from(feature_rtree)
+                    .join(asso_tp_2_f, asso_tp_2_f.c.feature_id == feature_rtree.c.id)
+                    .join(TranscriptPiece, TranscriptPiece.id == asso_tp_2_f.c.transcript_piece_id)
+                    .join(Transcript, Transcript.id == TranscriptPiece.transcript_id)
+                    .filter(feature_rtree.c.min_coordinate <= coordinate.id)
+                    .filter(feature_rtree.c.max_coordinate >= coordinate.id)
+                    .filter(feature_rtree.c.min_strand <= int(is_plus_strand))
+                    .filter(feature_rtree.c.max_strand >= int(is_plus_strand))
+                    .filter(feature_rtree.c.lower <= upper)
+                    .filter(feature_rtree.c.upper >= lower)
+                    .subquery())
+        return self.loader.ordered_super_locus_ids(coordinate.id, among=in_window)
+
+    def gen_window_super_loci(self, coordinate, start, end, is_plus_strand):
+        """super loci that might overlap the window, only those near it if the feature index exists"""
+        if self.has_feature_index:
+            sl_ids = self.overlapping_super_locus_ids(coordinate, start, end, is_plus_strand)
+            for i in range(0, len(sl_ids), self.load_batch_size):
+                for sl in self.loader.load_super_loci(sl_ids[i:(i + self.load_batch_size)]):
+                    yield sl
+        else:
+            for sl, sl_coordinate_seqid in self.genome_query([coordinate.genome.species], [],
+                                                             return_super_loci=True):
+                if sl_coordinate_seqid == coordinate.seqid:
+                    yield sl
 
     def coordinate_range_to_jsonable(self, species, seqid, start, end, is_plus_strand):
+        return self.coordinates_range_to_jsonable(self.get_coordinates(species, seqid), start, end,
+                                                  is_plus_strand)
+
+    def gen_super_locus_jsonables(self, coordinate, start, end, is_plus_strand):
+        for sl in self.gen_window_super_loci(coordinate, start, end, is_plus_strand):
+            slh = SuperLocusJsonable(sl)
+            if slh.overlaps(coordinate, start, end, is_plus_strand):
+                yield slh.to_jsonable(slh.data, coordinate, start, end, is_plus_strand)
+
+    def coordinates_range_to_jsonable(self, coordinates, start, end, is_plus_strand):
         out = []
-        for coordinate in self.session.query(Coordinate).filter(Coordinate.seqid == seqid).all():
-            if coordinate.genome.species == species:
-                ch = CoordinateJsonable(coordinate)
-                res = {'coordinate_piece': ch.to_jsonable(start, end),
-                       'super_loci': []}
-                for sl, sl_coordinate_seqid in self.genome_query([species], [], return_super_loci=True):
-                    if sl_coordinate_seqid == seqid:
-                        slh = SuperLocusJsonable(sl)
-                        if slh.overlaps(coordinate, start, end, is_plus_strand):
-                            res['super_loci'].append(slh.to_jsonable(slh.data, coordinate, start, end,
-                                                                     is_plus_strand))
-                out.append(res)
+        for coordinate in coordinates:
+            ch = CoordinateJsonable(coordinate)
+            res = {'coordinate_piece': ch.to_jsonable(start, end, self.sequence_cache),
+                   'super_loci': list(self.gen_super_locus_jsonables(coordinate, start, end,
+                                                                     is_plus_strand))}
+            out.append(res)
         return out
 
     def coordinate_range_to_json(self, species, seqid, start, end, is_plus_strand):
         return json.dumps(self.coordinate_range_to_jsonable(species, seqid, start, end, is_plus_strand))
 
+    def write_coordinate_range(self, handle_out, species, seqid, start, end, is_plus_strand,
+                               use_orjson=None):
+        self.write_coordinates_range(handle_out, self.get_coordinates(species, seqid), start, end,
+                                     is_plus_strand, use_orjson)
+
+    def write_coordinates_range(self, handle_out, coordinates, start, end, is_plus_strand,
+                                use_orjson=None):
+        """writes the same json as coordinate_range_to_json to the binary handle_out, serializing
+        one super locus at a time instead of building the whole structure first"""
+        dumps = json_dumper(use_orjson)
+        handle_out.write(b'[')
+        for i, coordinate in enumerate(coordinates):
+            if i:
+                handle_out.write(b', ')
+            ch = CoordinateJsonable(coordinate)
+            handle_out.write(b'{"coordinate_piece": ')
+            handle_out.write(dumps(ch.to_jsonable(start, end, self.sequence_cache)))
+            handle_out.write(b', "super_loci": [')
+            for j, serialized in enumerate(self.gen_serialized_super_loci(coordinate, start, end,
+                                                                         is_plus_strand, dumps)):
+                if j:
+                    handle_out.write(b', ')
+                handle_out.write(serialized)
+            handle_out.write(b']}')
+        handle_out.write(b']')
+
+    def gen_serialized_super_loci(self, coordinate, start, end, is_plus_strand, dumps):
+        """the super loci overlapping the window, each serialized with dumps"""
+        for sl_jsonable in self.gen_super_locus_jsonables(coordinate, start, end, is_plus_strand):
+            yield dumps(sl_jsonable)
+
 
 
 
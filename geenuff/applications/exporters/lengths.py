@@ -1,14 +1,106 @@
 import sys
 import numpy
 
-from geenuff.applications.exporter import GeenuffExportController
-from geenuff.base.orm import Coordinate
+from geenuff.applications.exporter import GeenuffExportController, MODES
+from geenuff.base.orm import (Coordinate, Genome, Feature, Transcript, TranscriptPiece,
+    association_transcript_piece_to_feature as asso_tp_2_f)
+from geenuff.base import types
+
+
+# modes whose lengths are stored per transcript on import
+PRECOMPUTED_LENGTHS = {'pre-mRNA': Transcript.pre_mrna_length,
+                       'mRNA': Transcript.mature_length,
+                       'CDS': Transcript.cds_length}
 
 
 class LengthExportController(GeenuffExportController):
     def __init__(self, db_path_in, longest=False):
         super().__init__(db_path_in, longest)
         self.export_ranges = []
+        # (seqid, length, species), the alternative to export_ranges, see prep_lengths
+        self.export_lengths = []
+        self._species_by_coordinate = None
+
+    def has_precomputed_lengths(self):
+        """whether the transcript lengths are filled for all transcripts (they are empty in dbs written
+        before they were stored on import, the columns are added when opening those)"""
+        missing = self.session.query(Transcript.id).filter(Transcript.mature_length.is_(None))
+        return missing.first() is None
+
+    def gen_precomputed_lengths(self, genomes, exclude, length_column):
+        """yields (seqid, length, species) of all transcripts (or the longest per super locus)
+        straight from the lengths stored on import"""
+        self._check_genome_names(genomes, exclude)
+        query = (self.session.query(Transcript.id, Transcript.given_name, Transcript.super_locus_id,
+                                    Transcript.mature_length, length_column, Genome.species)
+                    .join(TranscriptPiece, TranscriptPiece.transcript_id == Transcript.id)
+                    .join(asso_tp_2_f, asso_tp_2_f.c.transcript_piece_id == TranscriptPiece.id)
+                    .join(Feature, asso_tp_2_f.c.feature_id == Feature.id)
+                    .join(Coordinate, Feature.coordinate_id == Coordinate.id)
+                    .join(Genome, Genome.id == Coordinate.genome_id)
+                    .filter(TranscriptPiece.position == 0)
+                    .filter(Feature.type == types.GEENUFF_TRANSCRIPT))
+        query = self._filter_genomes(query, genomes, exclude)
+        query = (query
+                    .order_by(Genome.species)
+                    .order_by(Coordinate.length.desc())
+                    .order_by(Coordinate.id)
+                    .order_by(Feature.is_plus_strand)
+                    .order_by(Feature.start)
+                    .order_by(Transcript.id))
+        rows = query.all()
+        if self.longest:
+            # longest (with introns removed) per super locus, the first by id in case of a tie
+            longest = {}
+            for row in rows:
+                t_id, _, sl_id, mature_length, _, _ = row
+                if mature_length > 0:
+                    best = longest.get(sl_id)
+                    if best is None or (mature_length, -t_id) > (best[3], -best[0]):
+                        longest[sl_id] = row
+            rows = [row for row in rows if longest.get(row[2]) is row]
+        for _, given_name, _, _, length, species in rows:
+            if given_name is None:
+                given_name = 'unnamed_{0:08d}'.format(self.id_counter())
+            yield given_name, length, species
+
+    def species_of(self, export_group):
+        if self._species_by_coordinate is None:
+            self._species_by_coordinate = dict(self.session.query(Coordinate.id, Genome.species)
+                                                  .join(Genome, Genome.id == Coordinate.genome_id)
+                                                  .all())
+        if not export_group.ranges:
+            return None
+        return self._species_by_coordinate[export_group.ranges[0].coordinate_id]
+
+    def gen_mode_lengths(self, genomes, exclude, mode):
+        """yields (seqid, length, species) for every export group of mode, from the lengths stored
+        on import where possible and from the export ranges otherwise"""
+        if mode in PRECOMPUTED_LENGTHS and self.has_precomputed_lengths():
+            for seqid_length_species in self.gen_precomputed_lengths(genomes, exclude,
+                                                                     PRECOMPUTED_LENGTHS[mode]):
+                yield seqid_length_species
+        else:
+            for group in self.gen_ranges(genomes, exclude, MODES[mode]):
+                yield group.seqid, self.get_length(group), self.species_of(group)
+
+    def prep_lengths(self, genomes, exclude, mode):
+        """fills export_lengths, the lighter alternative to prep_ranges"""
+        self.export_lengths = list(self.gen_mode_lengths(genomes, exclude, mode))
+
+    def gen_lengths(self):
+        """(seqid, length) of everything prepped, by prep_lengths or prep_ranges"""
+        for seqid, length, _ in self.export_lengths:
+            yield seqid, length
+        for export_group in self.export_ranges:
+            yield export_group.seqid, self.get_length(export_group)
+
+    def gen_species_lengths(self):
+        """(species, length) of everything prepped, by prep_lengths or prep_ranges"""
+        for _, length, species in self.export_lengths:
+            yield species, length
+        for export_group in self.export_ranges:
+            yield self.species_of(export_group), self.get_length(export_group)
 
     @staticmethod
     def get_length(export_group):
@@ -27,59 +119,97 @@ class LengthExportController(GeenuffExportController):
 
     def write_lengths(self, file_out):
         handle_out = self._as_file_handle(file_out)
-        for export_group in self.export_ranges:
-            l = self.get_length(export_group)
-            handle_out.write("{}\t{}\n".format(export_group.seqid, l))
+        for seqid, l in self.gen_lengths():
+            handle_out.write("{}\t{}\n".format(seqid, l))
         handle_out.close()
 
-    def write_length_stats(self, file_out):
-        lengths = []
-        for export_group in self.export_ranges:
-            lengths.append(self.get_length(export_group))
-
-        stats = basics(lengths)
-        quants = fmt_keys(quantiles(lengths), pfx="quantile")
-        nxes = fmt_keys(nx(lengths), pfx="N", sfx="")
+    def write_length_stats(self, file_out, by_genome=False, quantile_x=None, nx_x=None):
+        self._write_stats(self.gen_species_lengths(), file_out, by_genome, quantile_x, nx_x)
+
+    def stream_length_stats(self, genomes, exclude, mode, file_out, by_genome=False,
+                            quantile_x=None, nx_x=None):
+        """as prep_lengths followed by write_length_stats, without keeping anything but the
+        lengths themselves"""
+        species_lengths = ((species, length) for _, length, species
+                           in self.gen_mode_lengths(genomes, exclude, mode))
+        self._write_stats(species_lengths, file_out, by_genome, quantile_x, nx_x)
+
+    def _write_stats(self, species_lengths, file_out, by_genome, quantile_x=None, nx_x=None):
+        all_stats = {}
+        for species, length in species_lengths:
+            key = species if by_genome else None
+            if key not in all_stats:
+                all_stats[key] = LengthStats(quantile_x=quantile_x, nx_x=nx_x)
+            all_stats[key].add(length)
+        if not all_stats:
+            all_stats[None] = LengthStats(quantile_x=quantile_x, nx_x=nx_x)
 
         handle_out = self._as_file_handle(file_out)
-        for group in [stats, quants, nxes]:
-            handle_out.write(fmt_stats(group))
+        for species in sorted(all_stats, key=str):
+            pfx = '{}\t'.format(species) if by_genome else ''
+            for group in all_stats[species].summarize():
+                handle_out.write(fmt_stats(group, pfx=pfx))
         handle_out.close()
 
 
-def fmt_stats(a_dict):
+class LengthStats(object):
+    """Collects lengths in a growing numpy array, all statistics are then calculated in one
+    vectorized pass in summarize"""
+    def __init__(self, capacity=1024, quantile_x=None, nx_x=None):
+        self._lengths = numpy.empty(capacity, dtype=numpy.int64)
+        self.count = 0
+        self.quantile_x = quantile_x
+        self.nx_x = nx_x
+
+    def add(self, length):
+        if self.count == len(self._lengths):
+            self._lengths = numpy.resize(self._lengths, 2 * len(self._lengths))
+        self._lengths[self.count] = length
+        self.count += 1
+
+    @property
+    def lengths(self):
+        return self._lengths[:self.count]
+
+    def summarize(self):
+        """basics, quantiles and N-values, as a list of dicts with labelled keys"""
+        if not self.count:
+            return [{'count': 0}]
+        return [basics(self.lengths),
+                fmt_keys(quantiles(self.lengths, self.quantile_x), pfx="quantile"),
+                fmt_keys(nx(self.lengths, self.nx_x), pfx="N", sfx="")]
+
+
+def fmt_stats(a_dict, pfx=''):
+    # in insertion order, which is sorted for the basics and follows the x values otherwise
     out = ""
-    for key in sorted(a_dict.keys()):
-        out += "{}\t{}\n".format(key, a_dict[key])
+    for key in a_dict:
+        out += "{}{}\t{}\n".format(pfx, key, a_dict[key])
     return out
 
 
 def basics(lengths):
+    lengths = numpy.asarray(lengths)
     out = {'count': len(lengths),
-           'longest': max(lengths),
-           'shortest': min(lengths),
-           'total': sum(lengths)}
+           'longest': int(lengths.max()),
+           'shortest': int(lengths.min()),
+           'total': int(lengths.sum())}
     return out
 
 
 def nx(lengths, x_vals=None):
+    """the length at which the (descending) lengths add up to at least x of the total, for each x"""
     if x_vals is None:
         x_vals = [.10, .25, .50, .75, .90]
 
+    lengths = numpy.sort(numpy.asarray(lengths))[::-1]
+    cummulative = numpy.cumsum(lengths)
+    targets = numpy.asarray(x_vals, dtype=float) * cummulative[-1]
+    # first position at which the cummulative length reaches each target
+    at = numpy.searchsorted(cummulative, targets, side='left')
     out = {}
-    for x in x_vals:
-        out[x] = None
-
-    lengths = sorted(lengths, reverse=True)
-    total = sum(lengths)
-    cummulative = 0
-    for l in lengths:
-        cummulative += l
-        # set as soon as we're beyond target value (and not again)
-        for key in out:
-            if out[key] is None:  # skip set values
-                if cummulative >= key * total:
-                    out[key] = l
+    for x, i in zip(x_vals, at.tolist()):
+        out[x] = int(lengths[i]) if i < len(lengths) else None
     return out
 
 
@@ -87,17 +217,31 @@ def quantiles(lengths, x_vals=None):
     if x_vals is None:
         x_vals = [.10, .25, .50, .75, .90]
 
-    out = {}
-    for key in x_vals:
-        out[key] = numpy.quantile(lengths, key)
-
-    return out
+    values = numpy.quantile(lengths, x_vals)
+    return dict(zip(x_vals, values.tolist()))
 
 
 def fmt_keys(a_dict, pfx, sfx="%", times_by=100):
     """convert fraction keys to labelled percentages (or similar)"""
     out = {}
     for key in a_dict:
-        new_key = "{}{}{}".format(pfx, int(key * times_by), sfx)
+        # round first, as e.g. int(0.29 * 100) would give 28
+        new_key = "{}{:g}{}".format(pfx, round(key * times_by, 6), sfx)
         out[new_key] = a_dict[key]
     return out
+
+
+def parse_x_grid(grid):
+    """fractions from a comma separated list of percentages and inclusive ranges of whole
+    percentages, e.g. '10,25,50' or '1-99' or '1-9,12.5,90-99'"""
+    percentages = set()
+    for item in grid.split(','):
+        item = item.strip()
+        if '-' in item:
+            start, end = item.split('-')
+            percentages.update(range(int(start), int(end) + 1))
+        else:
+            percentages.add(float(item))
+    if not percentages or not all(0 <= p <= 100 for p in percentages):
+        raise ValueError('percentages in {} have to be between 0 and 100'.format(grid))
+    return [p / 100 for p in sorted(percentages)]
@@ -1,54 +1,56 @@
 import sys
 
 from geenuff.applications.exporter import GeenuffExportController
-from geenuff.base.orm import Coordinate
 from geenuff.base.helpers import reverse_complement, chunk_str
 
+WRITE_BUFFER_SIZE = 2 ** 20
 
-class FastaExportController(GeenuffExportController):
-    def __init__(self, db_path_in, longest=False):
-        super().__init__(db_path_in, longest)
 
+class FastaExportController(GeenuffExportController):
     def get_seq(self, export_sequence):
-        # simple and probably horribly inefficient
-        out = []
-        last_coordinate, sequence = None, None
-        for a_range in export_sequence.ranges:
-            coord_id = a_range.coordinate_id
-            if last_coordinate != coord_id:
-                coordinate = self.session.query(Coordinate).filter(Coordinate.id == coord_id).first()
-                sequence = coordinate.sequence
-            out += self.get_seq_fragment(a_range, sequence)
-            last_coordinate = coord_id
-        return out
+        return ''.join(self.get_seq_fragment(a_range, self.sequence_cache)
+                       for a_range in export_sequence.ranges)
 
     def fmt_seq(self, export_sequence):
-        out = '>' + export_sequence.seqid
         seq = self.get_seq(export_sequence)
-        for subseq in chunk_str(seq, 80):
-            out += '\n' + ''.join(subseq)
-        return out
+        return '\n'.join(['>' + export_sequence.seqid] + list(chunk_str(seq, 80)))
 
     @staticmethod
-    def get_seq_fragment(fragment, sequence):
+    def get_seq_fragment(fragment, sequence_cache):
+        coord_id = fragment.coordinate_id
         if fragment.is_plus_strand:
-            out = sequence[fragment.start:fragment.end]
+            out = sequence_cache.get_slice(coord_id, fragment.start, fragment.end)
         else:
             # +1 to flip inclusive/exclusive
-            out = sequence[(fragment.end + 1):(fragment.start + 1)]
+            out = sequence_cache.get_slice(coord_id, fragment.end + 1, fragment.start + 1)
             out = reverse_complement(out)
         return out
 
-    def write_fa(self, fa_out):
-        # again, simple and probably horribly inefficient
+    def gen_fa_lines(self, export_sequence, line_length=80):
+        """yields one fasta record as bytes pieces (header, then line wrapped sequence), slicing
+        the sequence by memoryview so no per line copies are made"""
+        seq = memoryview(self.get_seq(export_sequence).encode('ascii'))
+        yield '>{}\n'.format(export_sequence.seqid).encode()
+        for i in range(0, len(seq), line_length):
+            yield seq[i:(i + line_length)]
+            yield b'\n'
+
+    def write_fa(self, fa_out, export_groups=None):
+        """writes export_groups (default: the prepped self.export_ranges) as fasta, one record at
+        a time"""
+        if export_groups is None:
+            export_groups = self.export_ranges
         if fa_out is None:
-            handle_out = sys.stdout
+            handle_out = sys.stdout.buffer
         else:
-            handle_out = open(fa_out, "w")
-        for export_seq in self.export_ranges:
-            handle_out.write(self.fmt_seq(export_seq))
-            handle_out.write('\n')
-        handle_out.close()
-
-
+            handle_out = open(fa_out, "wb", buffering=WRITE_BUFFER_SIZE)
+        for export_seq in export_groups:
+            handle_out.writelines(self.gen_fa_lines(export_seq))
+        if fa_out is None:
+            handle_out.flush()
+        else:
+            handle_out.close()
 
+    def stream_fa(self, genomes, exclude, range_function, fa_out):
+        """as prep_ranges followed by write_fa, but without holding more than one record"""
+        self.write_fa(fa_out, self.gen_ranges(genomes, exclude, range_function))
@@ -1,22 +1,27 @@
 import os
+import time
 import logging
+import multiprocessing
+from collections import deque
 from pprint import pprint  # for debugging
 from abc import ABC, abstractmethod
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker, object_session
+from sqlalchemy.schema import CreateTable
 
-from dustdas import gffhelper, fastahelper
 from .. import orm
 from .. import types
 from .. import helpers
+from ..base import storage, gff, fasta
 from ..base.helpers import (get_strand_direction, get_geenuff_start_end, has_start_codon,
-                            has_stop_codon, in_enum_values)
+                            has_stop_codon)
 
 
 # core queue prep
 class InsertionQueue(helpers.QueueController):
-    def __init__(self, session, engine):
-        super().__init__(session, engine)
+    def __init__(self, session, engine, flush_at=10000):
+        super().__init__(session, engine, flush_at)
         self.super_locus = helpers.CoreQueue(orm.SuperLocus.__table__.insert())
         self.transcript = helpers.CoreQueue(orm.Transcript.__table__.insert())
         self.transcript_piece = helpers.CoreQueue(orm.TranscriptPiece.__table__.insert())
@@ -54,6 +59,37 @@ class InsertCounterHolder(object):
         InsertCounterHolder.transcript_piece.sync_with_db(session)
         InsertCounterHolder.genome.sync_with_db(session)
 
+    @staticmethod
+    def reserve_id_blocks(entry_groups):
+        """Reserves a block of primary keys per table that is guaranteed to be large enough for
+        the importers made from entry_groups (the gene groups of one seqid). Returns a dict of
+        counter name: (block_start, block_end), ids in (block_start, block_end] may be used."""
+        n_entries = sum([len(group) for group in entry_groups])
+        # every gff entry yields at most one transcript, piece or protein, while features are bounded by
+        # the transcript feature, cds, introns and all possible error masks of each transcript
+        sizes = {'super_locus': len(entry_groups),
+                 'transcript': n_entries,
+                 'transcript_piece': n_entries,
+                 'protein': n_entries,
+                 'feature': n_entries * 10 + len(entry_groups)}
+        id_blocks = {}
+        for name, size in sizes.items():
+            id_blocks[name] = getattr(InsertCounterHolder, name).reserve(size)
+        return id_blocks
+
+    @staticmethod
+    def use_id_blocks(id_blocks):
+        for name, (block_start, _) in id_blocks.items():
+            getattr(InsertCounterHolder, name).move_to(block_start)
+
+    @staticmethod
+    def check_id_blocks(id_blocks):
+        for name, (_, block_end) in id_blocks.items():
+            at = getattr(InsertCounterHolder, name).at
+            if at > block_end:
+                raise ValueError('reserved id block for {} exhausted ({} > {})'.format(
+                    name, at, block_end))
+
 
 class OrganizedGeenuffImporterGroup(object):
     """Stores the handler objects for a super locus in an organized fashion.
@@ -226,17 +262,13 @@ class OrganizedGeenuffImporterGroup(object):
     @staticmethod
     def _get_protein_id_from_cds_entry(cds_entry):
         # check if anything is labeled as protein_id
-        protein_id = cds_entry.attrib_filter(tag='protein_id')
+        protein_id = cds_entry.get_attribute('protein_id')
         # failing that, try and get parent ID (presumably transcript, maybe gene)
         if not protein_id:
             protein_id = cds_entry.get_Parent()
         # hopefully take single hit
         if len(protein_id) == 1:
             protein_id = protein_id[0]
-            if isinstance(protein_id, gffhelper.GFFAttribute):
-                protein_id = protein_id.value
-                assert len(protein_id) == 1
-                protein_id = protein_id[0]
         # or handle other cases
         elif len(protein_id) == 0:
             protein_id = None
@@ -281,30 +313,27 @@ class OrganizedGFFEntryGroup(object):
     }
     """
 
-    def __init__(self, gff_entry_group, fasta_importer, controller):
-        self.fasta_importer = fasta_importer
+    def __init__(self, gff_entry_group, coord, controller):
         self.controller = controller
         self.entries = {'transcripts': {}}
-        self.coord = None
+        self.coord = coord
         self.add_gff_entry_group(gff_entry_group)
 
     def add_gff_entry_group(self, entries):
         latest_transcript = None
         for entry in list(entries):
-            if in_enum_values(entry.type, types.SuperLocusAll):
+            category = types.GFF_TYPE_CATEGORIES[entry.type]
+            if category == types.GFF_SUPER_LOCUS:
                 assert 'super_locus' not in self.entries
                 self.entries['super_locus'] = entry
-            elif in_enum_values(entry.type, types.TranscriptLevelAll):
+            elif category == types.GFF_TRANSCRIPT:
                 self.entries['transcripts'][entry] = {'exons': [], 'cds': []}
                 latest_transcript = entry
-            elif entry.type == types.EXON:
+            elif category == types.GFF_EXON:
                 self.entries['transcripts'][latest_transcript]['exons'].append(entry)
-            elif entry.type == types.CDS:
+            elif category == types.GFF_CDS:
                 self.entries['transcripts'][latest_transcript]['cds'].append(entry)
 
-        # set the coordinate
-        self.coord = self.fasta_importer.gffid_to_coords[self.entries['super_locus'].seqid]
-
         # order exon and cds lists by start value (disregard strand for now)
         for _, value_dict in self.entries['transcripts'].items():
             for key in ['exons', 'cds']:
@@ -317,8 +346,7 @@ class OrganizedGFFEntryGroup(object):
 
 
 class OrganizedGFFEntries(object):
-    """Structures the gff entries coming from gffhelper by seqid and gene. Also does some
-    basic gff value cleanup.
+    """Structures the gff entries coming from gff.read_gff by seqid and gene.
     The entries are organized in the following way:
 
     organized_entries = {
@@ -340,64 +368,54 @@ class OrganizedGFFEntries(object):
 
     def load_organized_entries(self):
         self.organized_entries = {}
-        gene_level = [x.value for x in types.SuperLocusAll]
+        for seqid, gene_groups in self.gen_organized_entries():
+            if seqid in self.organized_entries:
+                self.organized_entries[seqid] += gene_groups
+            else:
+                self.organized_entries[seqid] = gene_groups
+
+    def gen_organized_entries(self):
+        """Yields (seqid, [gene_group1, gene_group2, ..]) one seqid at a time, so that only
+        the entries of the current sequence have to be held in memory.
 
+        Assumes the gff is sorted so that all entries of one seqid are consecutive. Should a seqid
+        re-appear later in the file, its remaining gene groups are yielded as an additional batch."""
         reader = self._useful_gff_entries()
-        first = next(reader)
+        try:
+            first = next(reader)
+        except StopIteration:
+            return
         seqid = first.seqid
+        finished_seqids = set()
         gene_group = [first]
-        self.organized_entries[seqid] = []
+        gene_groups = []
         for entry in reader:
-            if entry.type in gene_level:
-                self.organized_entries[seqid].append(gene_group)
+            if types.GFF_TYPE_CATEGORIES[entry.type] == types.GFF_SUPER_LOCUS:
+                gene_groups.append(gene_group)
                 gene_group = [entry]
                 if entry.seqid != seqid:
-                    self.organized_entries[entry.seqid] = []
+                    yield seqid, gene_groups
+                    finished_seqids.add(seqid)
+                    gene_groups = []
                     seqid = entry.seqid
+                    if seqid in finished_seqids:
+                        logging.warning('entries for seqid {} are not consecutive in {}, error checking '
+                                        'will not span the separate blocks'.format(seqid, self.gff_file))
             else:
                 gene_group.append(entry)
-        self.organized_entries[seqid].append(gene_group)
+        gene_groups.append(gene_group)
+        yield seqid, gene_groups
 
     def _useful_gff_entries(self):
-        skipable = [x.value for x in types.IgnorableGFFFeatures]
-        reader = self._gff_gen()
-        for entry in reader:
-            if entry.type not in skipable:
+        for entry in self._gff_gen():
+            if types.GFF_TYPE_CATEGORIES[entry.type] != types.GFF_IGNORABLE:
                 yield entry
 
     def _gff_gen(self):
-        known = [x.value for x in types.AllKnownGFFFeatures]
-        reader = gffhelper.read_gff_file(self.gff_file)
-        for entry in reader:
-            if entry.type not in known:
+        for entry in gff.read_gff(self.gff_file):
+            if entry.type not in types.GFF_TYPE_CATEGORIES:
                 raise ValueError("unrecognized feature type from gff: {}".format(entry.type))
-            else:
-                self._clean_entry(entry)
-                yield entry
-
-    @staticmethod
-    def _clean_entry(entry):
-        # always present and integers
-        entry.start = int(entry.start)
-        entry.end = int(entry.end)
-        # clean up score
-        if entry.score == '.':
-            entry.score = None
-        else:
-            entry.score = float(entry.score)
-
-        # clean up phase
-        if entry.phase == '.':
-            entry.phase = None
-        else:
-            entry.phase = int(entry.phase)
-        assert entry.phase in [None, 0, 1, 2]
-
-        # clean up strand
-        if entry.strand == '.':
-            entry.strand = None
-        else:
-            assert entry.strand in ['+', '-']
+            yield entry
 
 
 class GFFErrorHandling(object):
@@ -409,8 +427,10 @@ class GFFErrorHandling(object):
     removed when deemed necessary.
     """
 
-    def __init__(self, geenuff_importer_groups, controller):
+    def __init__(self, geenuff_importer_groups, controller, sequence):
         self.groups = geenuff_importer_groups
+        # of the seqid, for the start/stop codon checks
+        self.sequence = sequence
         if self.groups:
             self.is_plus_strand = self.groups[0]['super_locus'].is_plus_strand
             self.coord = self.groups[0]['super_locus'].coord
@@ -525,9 +545,9 @@ class GFFErrorHandling(object):
                                                     mark_other_handlers=[transcript['transcript_feature']])
 
                     # the case of missing start/stop codon
-                    if not has_start_codon(cds.coord.sequence, cds.start, self.is_plus_strand):
+                    if not has_start_codon(self.sequence, cds.start, self.is_plus_strand):
                         self._add_overlapping_error(i, cds, '5p', types.MISSING_START_CODON)
-                    if not has_stop_codon(cds.coord.sequence, cds.end, self.is_plus_strand):
+                    if not has_stop_codon(self.sequence, cds.end, self.is_plus_strand):
                         self._add_overlapping_error(i, cds, '3p', types.MISSING_STOP_CODON)
 
                     # the case of wrong 5p phase
@@ -718,13 +738,36 @@ class GFFErrorHandling(object):
 
 
 ##### main flow control #####
+# sqlite settings trading durability for speed while bulk importing (fast_import), and the safe ones restored after
+FAST_IMPORT_PRAGMAS = ['PRAGMA journal_mode=WAL',
+                       'PRAGMA synchronous=OFF',
+                       'PRAGMA cache_size=-1048576',  # in KiB, i.e. 1GiB
+                       'PRAGMA mmap_size=4294967296',
+                       'PRAGMA temp_store=MEMORY']
+SAFE_PRAGMAS = ['PRAGMA journal_mode=DELETE',
+                'PRAGMA synchronous=FULL']
+
+
+def set_fast_import_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in FAST_IMPORT_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
 class ImportController(object):
-    def __init__(self, database_path, replace_db=False):
+    def __init__(self, database_path, replace_db=False, workers=1, flush_at=10000, fast_import=False,
+                 sequence_storage=types.PLAIN, chunk_size=storage.DEFAULT_CHUNK_SIZE):
         self.database_path = database_path
         self.latest_genome = None
+        self.workers = workers
+        self.fast_import = fast_import
+        self.sequence_storage = sequence_storage
+        self.chunk_size = chunk_size
         self._mk_session(replace_db)
-        # queues for adding to db
-        self.insertion_queues = InsertionQueue(session=self.session, engine=self.engine)
+        # queues for adding to db, written whenever one of them reaches flush_at rows
+        self.insertion_queues = InsertionQueue(session=self.session, engine=self.engine,
+                                               flush_at=flush_at)
 
     def _mk_session(self, replace_db):
         appending_to_db = False
@@ -736,16 +779,53 @@ class ImportController(object):
                 appending_to_db = True
                 print('appending to existing database at {}'.format(self.database_path))
         self.engine = create_engine(helpers.full_db_path(self.database_path), echo=False)
-        orm.Base.metadata.create_all(self.engine)
+        if self.fast_import:
+            event.listen(self.engine, 'connect', set_fast_import_pragmas)
+            self._create_tables_without_indexes()
+        else:
+            orm.upgrade_schema(self.engine)
         self.session = sessionmaker(bind=self.engine)()
         if appending_to_db:
             InsertCounterHolder.sync_counters_with_db(self.session)
 
+    def _create_tables_without_indexes(self):
+        """creates missing tables, leaving out the secondary indexes until finalize()
+        (the unique constraints are part of the table definition in sqlite and stay). Only the
+        coordinate indexes are made right away, they are small and sequences are looked up by sha1."""
+        existing = inspect(self.engine).get_table_names()
+        with self.engine.begin() as conn:
+            for table in orm.Base.metadata.sorted_tables:
+                if table.name not in existing:
+                    conn.execute(CreateTable(table))
+            orm.add_missing_columns(conn)
+            orm.create_missing_indexes(conn, tables=[orm.Coordinate.__table__])
+
+    def finalize(self):
+        """Writes and commits anything pending. After a fast_import, also builds the deferred
+        indexes and restores safe sqlite settings."""
+        self.insertion_queues.close()
+        self.session.commit()
+        if self.fast_import:
+            start = time.time()
+            with self.engine.begin() as conn:
+                orm.create_missing_indexes(conn)
+            logging.info('built deferred indexes in {:.2f}s'.format(time.time() - start))
+            event.remove(self.engine, 'connect', set_fast_import_pragmas)
+            self.session.close()
+            # drop pooled connections that still run without sync (would also drop an in-memory db),
+            # leaving the journal mode may only be changed by the last open connection
+            if self.engine.url.database not in (None, '', ':memory:'):
+                self.engine.dispose()
+            with self.engine.connect() as conn:
+                for pragma in SAFE_PRAGMAS:
+                    conn.execute(pragma)
+            self.fast_import = False
+
     def make_genome(self, genome_args=None):
         if genome_args is None:
             genome_args = {}
         genome = orm.Genome(**genome_args)
-        self.latest_fasta_importer = FastaImporter(genome)
+        self.latest_fasta_importer = FastaImporter(genome, self.sequence_storage, self.chunk_size)
         self.session.add(genome)
         self.session.commit()
 
@@ -770,67 +850,200 @@ class ImportController(object):
         self.latest_super_loci = []
 
     def add_gff(self, gff_file, clean=True):
-        def insert_importer_groups(self, groups):
-            """Initiates the calling of the add_to_queue() function of the importers
-            in the correct order. Also initiates the insert of the many2many rows.
-            """
-            for group in groups:
-                group['super_locus'].add_to_queue()
-                # insert all features as well as transcript and protein related entries
-                for transcripts in group['transcripts']:
-                    # make shortcuts
-                    tp = transcripts['transcript_piece']
-                    tf = transcripts['transcript_feature']
-                    # add transcript handler that are always present
-                    transcripts['transcript'].add_to_queue()
-                    tp.add_to_queue()
-                    tf.add_to_queue()
-                    tf.insert_feature_piece_association(tp.id)
-                    # if coding transcript
-                    if 'protein' in transcripts:
-                        transcripts['protein'].add_to_queue()
-                        transcripts['protein'].insert_transcript_protein_association(transcripts['transcript'].id)
-                        transcripts['cds'].insert_feature_protein_association(transcripts['protein'].id)
-                        transcripts['cds'].add_to_queue()
-                        transcripts['cds'].insert_feature_piece_association(tp.id)
-                    # if there are introns
-                    if 'introns' in transcripts:
-                        for intron in transcripts['introns']:
-                            intron.add_to_queue()
-                            intron.insert_feature_piece_association(tp.id)
-                # insert the errors
-                for error in group['errors']:
-                    error.add_to_queue()
-
-        def clean_and_insert(self, groups, clean):
-            plus = [g for g in groups if g['super_locus'].is_plus_strand]
-            minus = [g for g in groups if not g['super_locus'].is_plus_strand]
-            if clean:
-                # check and correct for errors
-                # do so for each strand seperately
-                # all changes should be made by reference
-                GFFErrorHandling(plus, self).resolve_errors()
-                # reverse order on minus strand
-                GFFErrorHandling(minus[::-1], self).resolve_errors()
-            # insert importers
-            insert_importer_groups(self, plus)
-            insert_importer_groups(self, minus)
-            self.insertion_queues.execute_so_far()
-
         assert self.latest_fasta_importer is not None, 'No recent genome found'
-        self.latest_fasta_importer.mk_mapper(gff_file)
+        self.latest_fasta_importer.mk_mapper()
         gff_organizer = OrganizedGFFEntries(gff_file)
-        gff_organizer.load_organized_entries()
-        organized_gff_entries = gff_organizer.organized_entries
-        geenuff_importer_groups = []
-        for seqid in organized_gff_entries.keys():
-            for entry_group in organized_gff_entries[seqid]:
-                organized_entries = OrganizedGFFEntryGroup(entry_group, self.latest_fasta_importer,
-                                                           self)
-                geenuff_importer_groups.append(organized_entries.get_geenuff_importers())
-            # never do error checking across fasta sequence borders
-            clean_and_insert(self, geenuff_importer_groups, clean)
-            geenuff_importer_groups = []
+        # stream one seqid at a time, so peak memory depends on the largest sequence, not the whole gff
+        seqid_batches = gff_organizer.gen_organized_entries()
+        if self.workers > 1:
+            self._add_gff_parallel(seqid_batches, clean)
+        else:
+            for seqid, entry_groups in seqid_batches:
+                coord = self.latest_fasta_importer.gffid_to_coords[seqid]
+                queue_entry_groups(entry_groups, coord, self, clean)
+                # the session reads the next sequence on another connection, which an open write
+                # transaction would lock out (once sqlite spills its page cache)
+                self.insertion_queues.commit()
+        self.insertion_queues.execute_so_far()
+        self.index_features(self.latest_fasta_importer.genome)
+
+    def index_features(self, genome):
+        """adds the features of genome to the spatial feature index used for region exports"""
+        start = time.time()
+        try:
+            with self.engine.begin() as conn:
+                # in a db that predates the index, the genomes already in it have to be indexed as well,
+                # as readers then rely on the index for all of them
+                genome_id = genome.id if orm.has_feature_rtree(conn) else None
+                orm.create_feature_rtree(conn)
+                orm.fill_feature_rtree(conn, genome_id)
+        except OperationalError as e:
+            # e.g. sqlite without the R*Tree module, region exports then scan the coordinates
+            logging.warning('could not build the feature index: {}'.format(e))
+            return
+        logging.info('indexed features in {:.2f}s'.format(time.time() - start))
+
+    def _add_gff_parallel(self, seqid_batches, clean):
+        """Fans the seqids out to a pool of SeqidImportWorkers. Results are written in gff order
+        by this (the only writing) process, and at most 2 * workers seqids are in flight at once."""
+        in_flight = deque()
+        with multiprocessing.Pool(self.workers) as pool:
+            for seqid, entry_groups in seqid_batches:
+                coord = self.latest_fasta_importer.gffid_to_coords[seqid]
+                id_blocks = InsertCounterHolder.reserve_id_blocks(entry_groups)
+                task = (entry_groups, DetachedCoordinate(coord, entry_groups if clean else None), clean, id_blocks)
+                in_flight.append(pool.apply_async(run_seqid_import_worker, (task,)))
+                if len(in_flight) >= 2 * self.workers:
+                    self._write_worker_rows(in_flight.popleft().get())
+            while in_flight:
+                self._write_worker_rows(in_flight.popleft().get())
+
+    def _write_worker_rows(self, rows_by_queue):
+        for queue, rows in zip(self.insertion_queues.ordered_queues, rows_by_queue):
+            queue.queue += rows
+        self.insertion_queues.flush_if_full()
+        # before the next sequence is read, see add_gff
+        self.insertion_queues.commit()
+
+
+def insert_importer_groups(groups, controller):
+    """Initiates the calling of the add_to_queue() function of the importers
+    in the correct order. Also initiates the insert of the many2many rows.
+    """
+    for group in groups:
+        controller.insertion_queues.flush_if_full()
+        group['super_locus'].add_to_queue()
+        # insert all features as well as transcript and protein related entries
+        for transcripts in group['transcripts']:
+            # make shortcuts
+            tp = transcripts['transcript_piece']
+            tf = transcripts['transcript_feature']
+            # add transcript handler that are always present
+            transcripts['transcript'].set_lengths(tf, transcripts.get('introns', []),
+                                                  transcripts.get('cds'))
+            transcripts['transcript'].add_to_queue()
+            tp.add_to_queue()
+            tf.add_to_queue()
+            tf.insert_feature_piece_association(tp.id)
+            # if coding transcript
+            if 'protein' in transcripts:
+                transcripts['protein'].add_to_queue()
+                transcripts['protein'].insert_transcript_protein_association(transcripts['transcript'].id)
+                transcripts['cds'].insert_feature_protein_association(transcripts['protein'].id)
+                transcripts['cds'].add_to_queue()
+                transcripts['cds'].insert_feature_piece_association(tp.id)
+            # if there are introns
+            if 'introns' in transcripts:
+                for intron in transcripts['introns']:
+                    intron.add_to_queue()
+                    intron.insert_feature_piece_association(tp.id)
+        # insert the errors
+        for error in group['errors']:
+            error.add_to_queue()
+
+
+def queue_entry_groups(entry_groups, coord, controller, clean):
+    """Converts the gff entry groups of one seqid to importers, checks them for errors
+    (if clean) and adds the resulting rows to controller.insertion_queues"""
+    groups = []
+    for entry_group in entry_groups:
+        organized_entries = OrganizedGFFEntryGroup(entry_group, coord, controller)
+        groups.append(organized_entries.get_geenuff_importers())
+
+    plus = [g for g in groups if g['super_locus'].is_plus_strand]
+    minus = [g for g in groups if not g['super_locus'].is_plus_strand]
+    if clean:
+        # check and correct for errors
+        # do so for each strand seperately
+        # all changes should be made by reference
+        # never do error checking across fasta sequence borders
+        # the sequence around the CDS ends is loaded at once for the codon checks of both strands
+        sequence = load_codon_windows(entry_groups, coord)
+        GFFErrorHandling(plus, controller, sequence).resolve_errors()
+        # reverse order on minus strand
+        GFFErrorHandling(minus[::-1], controller, sequence).resolve_errors()
+    # insert importers
+    insert_importer_groups(plus, controller)
+    insert_importer_groups(minus, controller)
+
+
+# bp around the start and end of every CDS entry loaded for the codon checks, a codon needs 3
+CODON_WINDOW_PADDING = 4
+
+
+def codon_windows(entry_groups, length):
+    """sorted, merged (start, end) ranges around the start and end of every CDS entry in entry_groups,
+    these contain everything the start/stop codon checks of GFFErrorHandling look at"""
+    positions = sorted([position for entry_group in entry_groups for entry in entry_group
+                        if types.GFF_TYPE_CATEGORIES[entry.type] == types.GFF_CDS
+                        for position in (entry.start, entry.end)])
+    windows = []
+    for position in positions:
+        start = max(position - CODON_WINDOW_PADDING, 0)
+        end = min(position + CODON_WINDOW_PADDING, length)
+        if windows and start <= windows[-1][1]:
+            windows[-1] = (windows[-1][0], max(windows[-1][1], end))
+        else:
+            windows.append((start, end))
+    return windows
+
+
+def load_codon_windows(entry_groups, coord):
+    windows = codon_windows(entry_groups, coord.length)
+    return helpers.SequenceWindows(windows, coord.get_slices(windows), coord.length)
+
+
+class DetachedCoordinate(object):
+    """Holds the attributes of an orm.Coordinate that the importers need, so they can be
+    sent to a worker process without the session. Only the sequence around the CDS ends of
+    entry_groups is loaded, for the codon checks, and only if entry_groups are given."""
+    def __init__(self, coord, entry_groups=None):
+        self.id = coord.id
+        self.seqid = coord.seqid
+        self.length = coord.length
+        self.codon_windows = None
+        if entry_groups is not None:
+            self.codon_windows = load_codon_windows(entry_groups, coord)
+
+    def get_slices(self, ranges):
+        return [self.codon_windows[start:end] for start, end in ranges]
+
+
+class SeqidImportWorker(object):
+    """Parses, error checks and queues the gene groups of one seqid in a worker process. Has
+    no database access; the queued rows are returned as plain dicts to be written by the
+    ImportController. Primary keys are taken from id blocks reserved in advance by the
+    controller, so that workers never collide."""
+    def __init__(self, entry_groups, coord, clean, id_blocks):
+        self.entry_groups = entry_groups
+        self.coord = coord
+        self.clean = clean
+        self.id_blocks = id_blocks
+        # never flushed, the rows are returned instead
+        self.insertion_queues = InsertionQueue(session=None, engine=None, flush_at=None)
+
+    def run(self):
+        InsertCounterHolder.use_id_blocks(self.id_blocks)
+        queue_entry_groups(self.entry_groups, self.coord, self, self.clean)
+        InsertCounterHolder.check_id_blocks(self.id_blocks)
+        return [queue.queue for queue in self.insertion_queues.ordered_queues]
+
+
+def run_seqid_import_worker(task):
+    return SeqidImportWorker(*task).run()
+
+
+class CoordinatesByGffId(dict):
+    """gff seqid: coordinate, filled in on first access via the mapper"""
+    def __init__(self, mapper, coords_by_seqid):
+        super().__init__()
+        self.mapper = mapper
+        self.coords_by_seqid = coords_by_seqid
+
+    def __missing__(self, gffid):
+        coord = self.coords_by_seqid[self.mapper(gffid)]
+        self[gffid] = coord
+        return coord
 
 
 class Insertable(ABC):
@@ -840,21 +1053,22 @@ class Insertable(ABC):
 
 
 class FastaImporter(object):
-    def __init__(self, genome):
+    def __init__(self, genome, sequence_storage=types.PLAIN, chunk_size=storage.DEFAULT_CHUNK_SIZE):
         self.genome = genome
+        self.sequence_storage = sequence_storage
+        self.chunk_size = chunk_size
         self.mapper = None
         self._coords_by_seqid = None
         self._gffid_to_coords = None
-        self._gff_seq_ids = None
+
+    @property
+    def session(self):
+        return object_session(self.genome)
 
     @property
     def gffid_to_coords(self):
-        if not self._gffid_to_coords:
-            self._gffid_to_coords = {}
-            for gffid in self._gff_seq_ids:
-                fa_id = self.mapper(gffid)
-                x = self.coords_by_seqid[fa_id]
-                self._gffid_to_coords[gffid] = x
+        if self._gffid_to_coords is None:
+            self._gffid_to_coords = CoordinatesByGffId(self.mapper, self.coords_by_seqid)
         return self._gffid_to_coords
 
     @property
@@ -863,33 +1077,102 @@ class FastaImporter(object):
             self._coords_by_seqid = {c.seqid: c for c in self.genome.coordinates}
         return self._coords_by_seqid
 
-    def mk_mapper(self, gff_file=None):
+    def mk_mapper(self):
+        """Sets up mapping from gff to fasta IDs. The gff IDs are matched as they are met during
+        the import, in the same pass that reads the gff entries."""
         fa_ids = [e.seqid for e in self.genome.coordinates]
-        if gff_file is not None:  # allow setup without ado when we know IDs match exactly
-            self._gff_seq_ids = helpers.get_seqids_from_gff(gff_file)
-        else:
-            self._gff_seq_ids = fa_ids
-        mapper, is_forward = helpers.two_way_key_match(fa_ids, self._gff_seq_ids)
-        self.mapper = mapper
-
-        if not is_forward:
-            raise NotImplementedError("Still need to implement backward match if fasta IDs "
-                                      "are subset of gff IDs")
+        self.mapper = helpers.IncrementalKeyMapper(fa_ids)
+        self._gffid_to_coords = None
 
     def add_sequences(self, seq_file):
-        self.add_fasta(seq_file)
+        sequence_file = self.find_imported_file(seq_file)
+        if sequence_file is None:
+            self.add_fasta(seq_file)
+        else:
+            logging.info('{} is unchanged since import, reusing its sequences'.format(seq_file))
+            self.add_from_imported_file(sequence_file)
+
+    @staticmethod
+    def _file_state(seq_file):
+        stat = os.stat(seq_file)
+        return os.path.abspath(seq_file), stat.st_size, stat.st_mtime
+
+    def find_imported_file(self, seq_file):
+        """the SequenceFile of an earlier import of seq_file, if it has not changed since"""
+        path, size, mtime = self._file_state(seq_file)
+        return (self.session.query(orm.SequenceFile)
+                   .filter(orm.SequenceFile.path == path)
+                   .filter(orm.SequenceFile.size == size)
+                   .filter(orm.SequenceFile.mtime == mtime)
+                   .first())
+
+    def add_from_imported_file(self, sequence_file):
+        """adds coordinates as read from sequence_file before, referencing the stored sequences"""
+        for coord in sorted(sequence_file.coordinates, key=lambda c: c.id):
+            source = coord.sequence_source or coord
+            new_coord = orm.Coordinate(seqid=coord.seqid, length=coord.length, sha1=coord.sha1,
+                                       genome=self.genome)
+            self.reference_sequence(new_coord, source)
 
     def add_fasta(self, seq_file, id_delim=' '):
-        fp = fastahelper.FastaParser()
-        for fasta_header, seq in fp.read_fasta(seq_file):
-            seq = seq.upper()  # this may perform poorly
-            seqid = fasta_header.split(id_delim)[0]
+        path, size, mtime = self._file_state(seq_file)
+        sequence_file = orm.SequenceFile(path=path, size=size, mtime=mtime)
+        for record in fasta.read_fasta(seq_file):
+            seqid = record.header.split(id_delim)[0]
+            # the sequence is measured and hashed while it is being encoded
+            encoded = self.encode_sequence(record.blocks())
+            # looked up before the new coordinate is pending, which it would match otherwise
+            source = self.find_sequence_source(record.sha1, record.length)
             # todo, parallelize sequence & annotation format, then import directly from ~Slice
-            coord = orm.Coordinate(sequence=seq,
-                                   length=len(seq),
+            coord = orm.Coordinate(length=record.length,
                                    seqid=seqid,
-                                   sha1=helpers.sequence_hash(seq),
+                                   sha1=record.sha1,
+                                   sequence_file=sequence_file,
                                    genome=self.genome)
+            if source is None:
+                self.add_sequence_to_coord(coord, encoded)
+            else:
+                # identical sequence stored already, e.g. an organelle or a re-imported assembly
+                logging.info('sequence of {} is identical to that of {}, referencing it'.format(
+                    seqid, source.seqid))
+                self.reference_sequence(coord, source)
+
+    def find_sequence_source(self, sha1, length):
+        """the first coordinate holding (not referencing) the sequence of sha1 and length, if any.
+        Coordinates added before are flushed by the query, so they are found as well."""
+        return (self.session.query(orm.Coordinate)
+                   .filter(orm.Coordinate.sha1 == sha1)
+                   .filter(orm.Coordinate.length == length)
+                   .filter(orm.Coordinate.sequence_source_id.is_(None))
+                   .order_by(orm.Coordinate.id)
+                   .first())
+
+    def encode_sequence(self, blocks):
+        """the sequence coming as uppercase ascii bytes blocks, as a str for plain storage and
+        as [(position, encoding, data), ...] chunks otherwise"""
+        if self.sequence_storage == types.PLAIN:
+            seq = bytearray()
+            for block in blocks:
+                seq += block
+            return seq.decode('ascii')
+        else:
+            return list(storage.encode_blocks(blocks, self.sequence_storage, self.chunk_size))
+
+    def add_sequence_to_coord(self, coord, encoded):
+        coord.sequence_storage = types.SequenceStorage[self.sequence_storage]
+        if self.sequence_storage == types.PLAIN:
+            coord.sequence = encoded
+        else:
+            coord.chunk_size = self.chunk_size
+            for position, encoding, data in encoded:
+                orm.SequenceChunk(coordinate=coord, position=position, data=data,
+                                  encoding=types.SequenceStorage[encoding])
+
+    @staticmethod
+    def reference_sequence(coord, source):
+        coord.sequence_source = source
+        coord.sequence_storage = source.sequence_storage
+        coord.chunk_size = source.chunk_size
 
 
 class SuperLocusImporter(Insertable):
@@ -1014,6 +1297,37 @@ class TranscriptImporter(Insertable):
         self.super_locus_id = super_locus_id
         self.controller = controller
         self.longest = longest
+        self.pre_mrna_length = None
+        self.mature_length = None
+        self.cds_length = None
+        self.utr_length = None
+
+    @staticmethod
+    def _remaining_length(feature, to_subtract):
+        """length of the [min, max) range of feature that is not covered by any in to_subtract,
+        the same way the exporter subtracts ranges"""
+        lower, upper = sorted([feature.start, feature.end])
+        clipped = sorted((max(lower, min(f.start, f.end)), min(upper, max(f.start, f.end)))
+                         for f in to_subtract)
+        covered, reach = 0, lower
+        for start, end in clipped:
+            start = max(start, reach)
+            if end > start:
+                covered += end - start
+                reach = end
+        return upper - lower - covered
+
+    def set_lengths(self, transcript_feature, introns, cds=None):
+        """pre-mRNA, mature RNA, CDS and UTR length as the exporter would find them, to be called
+        once the features are final (after error handling)"""
+        self.pre_mrna_length = self._remaining_length(transcript_feature, [])
+        self.mature_length = self._remaining_length(transcript_feature, introns)
+        if cds is None:
+            self.cds_length = 0
+            self.utr_length = self.mature_length
+        else:
+            self.cds_length = self._remaining_length(cds, introns)
+            self.utr_length = self._remaining_length(transcript_feature, introns + [cds])
 
     def add_to_queue(self):
         transcript = self._get_params_dict()
@@ -1026,6 +1340,10 @@ class TranscriptImporter(Insertable):
             'given_name': self.given_name,
             'super_locus_id': self.super_locus_id,
             'longest': self.longest,
+            'pre_mrna_length': self.pre_mrna_length,
+            'mature_length': self.mature_length,
+            'cds_length': self.cds_length,
+            'utr_length': self.utr_length,
         }
         return d
 
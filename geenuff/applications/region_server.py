@@ -0,0 +1,178 @@
+import io
+import json
+import time
+import logging
+from collections import OrderedDict, deque
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import unquote
+
+import numpy
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from geenuff.applications.exporters.json import JsonExportController, SuperLocusJsonable
+from geenuff.base.orm import Coordinate, Genome, add_missing_column_views, warn_about_missing_indexes
+from geenuff.base.helpers import full_db_path
+
+DEFAULT_SUPER_LOCUS_CACHE_SIZE = 10000
+# serializations kept per cached super locus, one for each distinct way windows cut it
+SERIALIZED_WINDOWS_KEPT = 4
+TIMINGS_KEPT = 10000
+
+
+class RegionExportController(JsonExportController):
+    """Keeps the super loci it served in an LRU cache of up to cache_size entries, each with its
+    SuperLocusJsonable (so it is loaded and prepared once) and its serializations by the window
+    checks of all its parts (as only those change between windows)."""
+    def __init__(self, db_path_in, cache_size=DEFAULT_SUPER_LOCUS_CACHE_SIZE):
+        super().__init__(db_path_in)
+        self.cache_size = cache_size
+        # super locus id: (SuperLocusJsonable, {(dumps, window checks): serialized}), least recently used first
+        self.super_loci = OrderedDict()
+        self.n_cache_hits = 0
+        self.n_cache_misses = 0
+
+    def _mk_session(self):
+        # a single connection that stays open, it is made in the thread starting the service but
+        # used by the one serving the requests
+        self.engine = create_engine(full_db_path(self.db_path_in), echo=False, poolclass=StaticPool,
+                                    connect_args={'check_same_thread': False})
+        event.listen(self.engine, 'connect', add_missing_column_views)
+        warn_about_missing_indexes(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+
+    def _window_entries(self, coordinate, start, end, is_plus_strand):
+        """cache entries of the super loci that might overlap the window, loading the missing ones"""
+        if self.has_feature_index:
+            sl_ids = self.overlapping_super_locus_ids(coordinate, start, end, is_plus_strand)
+        else:
+            sl_ids = self.loader.ordered_super_locus_ids(coordinate.id)
+        entries = {}
+        for sl_id in sl_ids:
+            if sl_id in self.super_loci:
+                self.super_loci.move_to_end(sl_id)
+                entries[sl_id] = self.super_loci[sl_id]
+        missing = [sl_id for sl_id in sl_ids if sl_id not in entries]
+        self.n_cache_hits += len(entries)
+        self.n_cache_misses += len(missing)
+        for i in range(0, len(missing), self.load_batch_size):
+            for sl in self.loader.load_super_loci(missing[i:(i + self.load_batch_size)]):
+                entries[sl.id] = self.super_loci[sl.id] = (SuperLocusJsonable(sl), OrderedDict())
+        while len(self.super_loci) > self.cache_size:
+            self.super_loci.popitem(last=False)
+        return [entries[sl_id] for sl_id in sl_ids]
+
+    def gen_serialized_super_loci(self, coordinate, start, end, is_plus_strand, dumps):
+        for slh, serialized in self._window_entries(coordinate, start, end, is_plus_strand):
+            if not slh.overlaps(coordinate, start, end, is_plus_strand):
+                continue
+            key = (dumps, slh.all_window_checks(coordinate, start, end, is_plus_strand))
+            if key not in serialized:
+                serialized[key] = dumps(slh.to_jsonable(slh.data, coordinate, start, end, is_plus_strand))
+                if len(serialized) > SERIALIZED_WINDOWS_KEPT:
+                    serialized.popitem(last=False)
+            yield serialized[key]
+
+
+class RegionQueryService(object):
+    """Answers region queries from one long lived RegionExportController (so one warm session,
+    sequence cache and super locus cache). Keeps all coordinates in a (species, seqid) lookup table
+    and the timings of recent requests."""
+    def __init__(self, db_path_in, cache_size=DEFAULT_SUPER_LOCUS_CACHE_SIZE):
+        self.controller = RegionExportController(db_path_in, cache_size)
+        self.coordinates = self._mk_coordinate_table()
+        self.timings = deque(maxlen=TIMINGS_KEPT)
+        self.n_requests = 0
+
+    def _mk_coordinate_table(self):
+        table = {}
+        query = (self.controller.session.query(Coordinate, Genome.species)
+                    .join(Genome, Genome.id == Coordinate.genome_id))
+        for coordinate, species in query.all():
+            table.setdefault((species, coordinate.seqid), []).append(coordinate)
+        return table
+
+    def region_json(self, species, seqid, start, end, is_plus_strand):
+        """serialized region (bytes), or None if there is no such coordinate"""
+        coordinates = self.coordinates.get((species, seqid))
+        if coordinates is None:
+            return None
+        handle_out = io.BytesIO()
+        self.controller.write_coordinates_range(handle_out, coordinates, start, end, is_plus_strand)
+        return handle_out.getvalue()
+
+    def record_timing(self, seconds):
+        self.n_requests += 1
+        self.timings.append(seconds)
+
+    def metrics(self):
+        out = {'requests': self.n_requests,
+               'cache_hits': self.controller.n_cache_hits,
+               'cache_misses': self.controller.n_cache_misses,
+               'cached_super_loci': len(self.controller.super_loci),
+               'coordinates': len(self.coordinates)}
+        if self.timings:
+            ms = numpy.array(self.timings) * 1000
+            p50, p95 = numpy.percentile(ms, [50, 95]).tolist()
+            out.update({'mean_ms': float(ms.mean()), 'p50_ms': p50, 'p95_ms': p95,
+                        'max_ms': float(ms.max())})
+        return out
+
+
+class RegionRequestHandler(BaseHTTPRequestHandler):
+    """GET /region/<species>/<seqid>/<start>/<end>/<strand> with strand as + or -, all url
+    quoted; and GET /metrics"""
+    service = None  # set by make_server
+
+    def do_GET(self):
+        start_time = time.time()
+        parts = [unquote(p) for p in self.path.strip('/').split('/')]
+        if parts == ['metrics']:
+            self._respond(200, json.dumps(self.service.metrics()))
+            return
+        try:
+            species, seqid, start, end, is_plus_strand = self._parse_region(parts)
+        except ValueError as e:
+            self._respond(400, json.dumps({'error': str(e)}))
+            return
+        out = self.service.region_json(species, seqid, start, end, is_plus_strand)
+        elapsed = time.time() - start_time
+        self.service.record_timing(elapsed)
+        if out is None:
+            self._respond(404, json.dumps({'error': 'no coordinate {} for {}'.format(seqid, species)}),
+                          elapsed)
+        else:
+            self._respond(200, out, elapsed)
+
+    @staticmethod
+    def _parse_region(parts):
+        # seqids may contain '/', so species from the left and the rest from the right
+        if len(parts) < 6 or parts[0] != 'region':
+            raise ValueError('expected /region/<species>/<seqid>/<start>/<end>/<strand>')
+        species, seqid = parts[1], '/'.join(parts[2:-3])
+        start, end, strand = parts[-3:]
+        if strand not in ('+', '-'):
+            raise ValueError('strand has to be + or -, not {}'.format(strand))
+        return species, seqid, int(start), int(end), strand == '+'
+
+    def _respond(self, status, body, elapsed=None):
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if elapsed is not None:
+            self.send_header('Server-Timing', 'region;dur={:.3f}'.format(elapsed * 1000))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+def make_server(db_path_in, host='127.0.0.1', port=8000, cache_size=DEFAULT_SUPER_LOCUS_CACHE_SIZE):
+    """single threaded, as the service shares one db session"""
+    handler = type('BoundRegionRequestHandler', (RegionRequestHandler,),
+                   {'service': RegionQueryService(db_path_in, cache_size)})
+    return HTTPServer((host, port), handler)
@@ -0,0 +1,81 @@
+"""Reads plain, gzipped or bgzipped fasta files.
+
+The file is read in large blocks (extended to the next line end, so that no line is split),
+from which the sequence lines are uppercased and joined with a single bytes.translate call each.
+The sequence of a record comes in these blocks, so that it can be hashed and stored on the way
+instead of being held as several full copies.
+"""
+import hashlib
+from itertools import groupby, chain
+from operator import itemgetter
+
+from .helpers import open_maybe_gzipped
+
+
+DEFAULT_BLOCK_SIZE = 2 ** 22
+UPPERCASE = bytes.maketrans(b'abcdefghijklmnopqrstuvwxyz', b'ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+WHITESPACE = b' \t\r\n'
+
+
+class FastaRecord(object):
+    """The header of one record and its sequence as uppercase bytes blocks. The blocks can be
+    read once, and the length and sha1 of the sequence are filled in while doing so."""
+    def __init__(self, header, blocks):
+        self.header = header
+        self._blocks = blocks
+        self.length = 0
+        self._sha1 = hashlib.sha1()
+
+    def blocks(self):
+        for block in self._blocks:
+            self.length += len(block)
+            self._sha1.update(block)
+            yield block
+
+    def read(self):
+        return b''.join(self.blocks()).decode('ascii')
+
+    @property
+    def sha1(self):
+        return self._sha1.hexdigest()
+
+    def __repr__(self):
+        return '<FastaRecord {}>'.format(self.header)
+
+
+def _gen_indexed_blocks(handle, block_size):
+    """(record index, header, sequence block) for all records, with an empty block right at each
+    header so that records without sequence are seen as well"""
+    index, header = -1, None
+    while True:
+        block = handle.read(block_size)
+        if not block:
+            break
+        block += handle.readline()
+        pos = 0
+        while pos < len(block):
+            if block.startswith(b'>', pos):
+                eol = block.find(b'\n', pos)
+                if eol == -1:
+                    eol = len(block)
+                index, header = index + 1, block[pos + 1:eol].decode().strip()
+                yield index, header, b''
+                pos = eol + 1
+            else:
+                next_header = block.find(b'\n>', pos)
+                end = len(block) if next_header == -1 else next_header + 1
+                sequence = block[pos:end].translate(UPPERCASE, WHITESPACE)
+                if sequence:
+                    if header is None:
+                        raise ValueError('sequence found before the first fasta header')
+                    yield index, header, sequence
+                pos = end
+
+
+def read_fasta(fasta_file, block_size=DEFAULT_BLOCK_SIZE):
+    """yields a FastaRecord for each record of fasta_file. The sequence blocks of each record
+    have to be read before moving to the next record, or they are skipped."""
+    with open_maybe_gzipped(fasta_file, 'rb') as handle:
+        for _, group in groupby(_gen_indexed_blocks(handle, block_size), key=itemgetter(0)):
+            _, header, first_block = next(group)
+            yield FastaRecord(header, chain([first_block], (block for _, _, block in group)))
@@ -0,0 +1,96 @@
+"""Reads the GFF3 entries that GeenuFF imports.
+
+Lines are split once into their nine columns and the numeric columns converted right away, while
+the attribute column is kept as is and only parsed on first use (which during import means for
+the ID, Parent and protein_id of a few entry types).
+"""
+from .helpers import open_maybe_gzipped
+
+
+_STRANDS = {'+': '+', '-': '-', '.': None}
+_PHASES = {'0': 0, '1': 1, '2': 2, '.': None}
+
+
+class GFFEntry(object):
+    __slots__ = ['seqid', 'source', 'type', 'start', 'end', 'score', 'strand', 'phase', 'attributes',
+                 '_attribute_dict']
+
+    def __init__(self, seqid, source, type, start, end, score, strand, phase, attributes):
+        self.seqid = seqid
+        self.source = source
+        self.type = type
+        self.start = start
+        self.end = end
+        self.score = score
+        self.strand = strand
+        self.phase = phase
+        self.attributes = attributes
+        self._attribute_dict = None
+
+    def get_attribute(self, tag):
+        """all values of tag as list (empty if missing)"""
+        if self._attribute_dict is None:
+            self._attribute_dict = parse_attributes(self.attributes)
+        return self._attribute_dict.get(tag, [])
+
+    def get_ID(self):
+        ids = self.get_attribute('ID')
+        if len(ids) > 1:
+            raise ValueError('more than one ID in {}'.format(self.attributes))
+        elif ids:
+            return ids[0]
+        return None
+
+    def get_Parent(self):
+        return self.get_attribute('Parent')
+
+    def __repr__(self):
+        return '<GFFEntry {} {} {}:{}-{}{}>'.format(self.type, self.get_ID(), self.seqid, self.start,
+                                                    self.end, self.strand or '')
+
+
+def parse_attributes(attributes):
+    out = {}
+    for attribute in attributes.split(';'):
+        tag, is_pair, value = attribute.strip().partition('=')
+        if is_pair:
+            out.setdefault(tag, []).extend(value.split(','))
+    return out
+
+
+def parse_line(line):
+    """GFFEntry from a (stripped) line, with start, end and phase as int, score as float and
+    missing values as None"""
+    columns = line.split('\t', 8)
+    if len(columns) < 8:
+        raise ValueError('expected 9 tab separated columns, but found {}'.format(len(columns)))
+    seqid, source, type_, start, end, score, strand, phase = columns[:8]
+    attributes = columns[8] if len(columns) == 9 else ''
+    try:
+        strand = _STRANDS[strand]
+    except KeyError:
+        raise ValueError('cannot interpret strand "{}"'.format(strand))
+    try:
+        phase = _PHASES[phase]
+    except KeyError:
+        raise ValueError('cannot interpret phase "{}"'.format(phase))
+    score = None if score == '.' else float(score)
+    return GFFEntry(seqid, source, type_, int(start), int(end), score, strand, phase, attributes)
+
+
+def read_gff(gff_file):
+    """yields a GFFEntry for every line of a plain or gzipped gff file, up to a ##FASTA section"""
+    with open_maybe_gzipped(gff_file) as f:
+        for i, line in enumerate(f, start=1):
+            if line.startswith('#'):
+                if line.startswith('##FASTA'):
+                    break
+                continue
+            line = line.rstrip()
+            if not line:
+                continue
+            try:
+                entry = parse_line(line)
+            except ValueError as e:
+                raise ValueError('{}, line {}: {}'.format(gff_file, i, e))
+            yield entry
@@ -1,6 +1,9 @@
+import time
+import gzip
 import logging
 import copy
 import hashlib
+import bisect
 
 
 ##### General #####
@@ -10,8 +13,23 @@ def sequence_hash(sequence):
     return sha1.hexdigest()
 
 
+def open_maybe_gzipped(path, mode='rt'):
+    """opens plain and gzipped (or bgzipped) files alike, the latter are recognized by their magic
+    number"""
+    with open(path, 'rb') as f:
+        is_gzipped = f.read(2) == b'\x1f\x8b'
+    if is_gzipped:
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+_enum_value_sets = {}
+
+
 def in_enum_values(x, enum):
-    return x in [item.value for item in enum]
+    if enum not in _enum_value_sets:
+        _enum_value_sets[enum] = frozenset(item.value for item in enum)
+    return x in _enum_value_sets[enum]
 
 
 def none_to_list(x):
@@ -145,6 +163,37 @@ def two_way_key_match(known_keys, other_keys):
     return mapper, forward
 
 
+class IncrementalKeyMapper(Mapper):
+    """Matches other keys to the known keys one at a time, as they are met, so that (unlike for
+    make_key_mapper) the other keys don't have to be collected up front. Keys that are known map
+    to themselves, others to the one known key they are a substring of."""
+    def __init__(self, known_keys):
+        self.known_keys = set(known_keys)
+        self.key_vals = {}
+        self._matched_by = {}
+
+    def __call__(self, key, *args, **kwargs):
+        if key not in self.key_vals:
+            self.key_vals[key] = self._match(key)
+        return self.key_vals[key]
+
+    def _match(self, key):
+        if key in self.known_keys:
+            match = key
+        else:
+            matches = [x for x in self.known_keys if key in x]
+            if len(matches) != 1:
+                raise NonMatchableIDs('could not identify unique match for {} in known keys, e.g. {}, but '
+                                      'instead got {}'.format(key, list(self.known_keys)[:4], matches))
+            match = matches[0]
+            logging.info("matched non-identical IDs {} and {}".format(key, match))
+        # check we match to _unique_ known keys
+        if match in self._matched_by:
+            raise NonMatchableIDs('both {} and {} match {}'.format(self._matched_by[match], key, match))
+        self._matched_by[match] = key
+        return match
+
+
 def get_seqids_from_gff(gfffile):
     seqids = set()
     with open(gfffile) as f:
@@ -200,25 +249,57 @@ def mk_rc_key():
 
 # so one doesn't recalculate it for every call of revers_complement
 REV_COMPLEMENT_KEY = mk_rc_key()
+REV_COMPLEMENT_TABLE = str.maketrans(REV_COMPLEMENT_KEY)
+REV_COMPLEMENT_BYTES_TABLE = bytes.maketrans(''.join(REV_COMPLEMENT_KEY.keys()).encode('ascii'),
+                                             ''.join(REV_COMPLEMENT_KEY.values()).encode('ascii'))
+# translating with this leaves only the characters that have no complement
+REV_COMPLEMENT_INVALID_TABLE = str.maketrans('', '', ''.join(REV_COMPLEMENT_KEY.keys()))
+REV_COMPLEMENT_BYTES_VALID = ''.join(REV_COMPLEMENT_KEY.keys()).encode('ascii')
 
 
 def reverse_complement(seq):
-    key = REV_COMPLEMENT_KEY
-    rc_seq = []
-    for base in reversed(seq):
-        try:
-            rc_seq.append(key[base])
-        except KeyError as e:
-            raise KeyError('{} caused by non DNA character {}'.format(e, base))
-    return rc_seq
+    """reverse complement of a str or bytes sequence, returned as the same type"""
+    if isinstance(seq, (bytes, bytearray)):
+        invalid = seq.translate(None, REV_COMPLEMENT_BYTES_VALID)
+        if invalid:
+            base = chr(invalid[-1])
+            raise KeyError('{} caused by non DNA character {}'.format(repr(base), base))
+        return seq.translate(REV_COMPLEMENT_BYTES_TABLE)[::-1]
+    invalid = seq.translate(REV_COMPLEMENT_INVALID_TABLE)
+    if invalid:
+        base = invalid[-1]  # the first one hit when reading seq backwards
+        raise KeyError('{} caused by non DNA character {}'.format(repr(base), base))
+    return seq.translate(REV_COMPLEMENT_TABLE)[::-1]
 
 
 ##### Start/Stop codon detection #####
 
 START_CODON = 'ATG'
-START_CODON_COMP = ''.join(reverse_complement(START_CODON))
+START_CODON_COMP = reverse_complement(START_CODON)
 STOP_CODONS = ['TAG', 'TGA', 'TAA']
-STOP_CODONS_COMP = [''.join(reverse_complement(c)) for c in STOP_CODONS]
+STOP_CODONS_COMP = [reverse_complement(c) for c in STOP_CODONS]
+
+
+class SequenceWindows(object):
+    """Parts of a sequence, that can be sliced like the str of the whole sequence (negative
+    positions are treated as 0) as long as the slice lies within one of the windows.
+    windows are sorted, non overlapping (start, end) ranges, slices the sequence of each."""
+    def __init__(self, windows, slices, length):
+        self.starts = [start for start, _ in windows]
+        self.windows = windows
+        self.slices = slices
+        self.length = length
+
+    def __getitem__(self, item):
+        assert isinstance(item, slice) and item.step is None
+        start = max(item.start, 0)
+        end = min(max(item.stop, 0), self.length)
+        if start >= end:
+            return ''
+        i = bisect.bisect_right(self.starts, start) - 1
+        assert i >= 0 and end <= self.windows[i][1], '{}:{} is outside the loaded windows'.format(start, end)
+        offset = self.windows[i][0]
+        return self.slices[i][(start - offset):(end - offset)]
 
 
 def substr_seq(seq, start, end, is_plus_strand):
@@ -260,26 +341,93 @@ class Counter(object):
         self._at += 1
         return self._at
 
+    @property
+    def at(self):
+        """the last value handed out"""
+        return self._at
+
+    def reserve(self, n):
+        """skips n values, returns (block_start, block_end) so that (block_start, block_end] are
+        reserved for whoever moves a counter there with move_to(block_start)"""
+        block = (self._at, self._at + n)
+        self._at += n
+        return block
+
+    def move_to(self, at):
+        self._at = at
+
 
 class QueueController(object):
-    def __init__(self, session, engine):
+    """Bulk writes the rows collected in ordered_queues (parents before children) through
+    one reused connection and an explicit transaction, in chunks of at most flush_at rows. The
+    transaction stays open over flushes until commit(), which is a no-op if nothing was flushed."""
+    def __init__(self, session, engine, flush_at=10000):
         self.session = session
         self.engine = engine
-        print('setting up QC x_x')
-        print(self.session)
-        print(self.engine)
+        self.flush_at = flush_at
         self.ordered_queues = []
-
-    def execute_so_far(self):
-        conn = self.engine.connect()
+        self.connection = None
+        self.transaction = None
+
+    def flush_if_full(self):
+        """writes all queues as soon as any of them holds flush_at rows"""
+        if self.flush_at and any([len(queue.queue) >= self.flush_at for queue in self.ordered_queues]):
+            self.flush()
+
+    def flush(self):
+        """writes everything queued so far within the open transaction, without committing"""
+        if self.connection is None:
+            self.connection = self.engine.connect()
+        if self.transaction is None:
+            self.transaction = self.connection.begin()
         for queue in self.ordered_queues:
             if queue.queue:
-                conn.execute(queue.action, queue.queue)
+                start = time.time()
+                if self.flush_at:
+                    chunks = chunk_str(queue.queue, self.flush_at)
+                else:
+                    chunks = [queue.queue]
+                for chunk in chunks:
+                    self.connection.execute(queue.action, chunk)
+                queue.log_written(len(queue.queue), time.time() - start)
                 del queue.queue[:]
-        self.session.commit()
+
+    def commit(self):
+        """commits what was flushed, so that other connections can read (and write) again"""
+        if self.transaction is not None:
+            self.transaction.commit()
+            self.transaction = None
+
+    def execute_so_far(self):
+        self.flush()
+        self.commit()
+        self.log_write_rates()
+
+    def log_write_rates(self):
+        for queue in self.ordered_queues:
+            if queue.rows_written:
+                logging.info('wrote {} rows to {} in {:.2f}s ({:.0f} rows/s)'.format(
+                    queue.rows_written, queue.table_name, queue.seconds_writing,
+                    queue.rows_written / max(queue.seconds_writing, 1e-9)))
+
+    def close(self):
+        self.commit()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
 
 
 class CoreQueue(object):
     def __init__(self, action):
         self.queue = []
         self.action = action
+        self.rows_written = 0
+        self.seconds_writing = 0.
+
+    @property
+    def table_name(self):
+        return self.action.table.name
+
+    def log_written(self, n_rows, seconds):
+        self.rows_written += n_rows
+        self.seconds_writing += seconds
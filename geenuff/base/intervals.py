@@ -0,0 +1,46 @@
+"""Interval arithmetic on half open [lower, upper) intervals, given as (group, lower, upper).
+
+Operations only ever combine intervals from the same group (e.g. one per coordinate, piece and
+strand). They are sorted sweeps in plain python, the few intervals of e.g. one transcript are
+handled faster that way than by setting up numpy arrays (or interval trees) for them.
+"""
+import bisect
+from collections import defaultdict
+
+
+def _union_by_group(intervals):
+    """{group: (lowers, uppers)}, sorted and disjoint, covering the same positions as intervals"""
+    by_group = defaultdict(list)
+    for group, lower, upper in intervals:
+        by_group[group].append((lower, upper))
+    blocks = {}
+    for group, group_intervals in by_group.items():
+        lowers, uppers = [], []
+        for lower, upper in sorted(group_intervals):
+            # a new block starts wherever the start lies beyond everything seen so far
+            if uppers and lower <= uppers[-1]:
+                uppers[-1] = max(uppers[-1], upper)
+            else:
+                lowers.append(lower)
+                uppers.append(upper)
+        blocks[group] = (lowers, uppers)
+    return blocks
+
+
+def subtract(keep_from, to_subtract):
+    """the parts of each interval in keep_from that are not covered by any interval of the same
+    group in to_subtract, as (index in keep_from, group, lower, upper). Intervals in keep_from
+    are handled individually (not merged)."""
+    blocks = _union_by_group(to_subtract)
+    for i, (group, lower, upper) in enumerate(keep_from):
+        if group in blocks:
+            block_lowers, block_uppers = blocks[group]
+            # the first block ending after lower
+            j = bisect.bisect_right(block_uppers, lower)
+            while lower < upper and j < len(block_lowers) and block_lowers[j] < upper:
+                if block_lowers[j] > lower:
+                    yield i, group, lower, block_lowers[j]
+                lower = max(lower, block_uppers[j])
+                j += 1
+        if lower < upper:
+            yield i, group, lower, upper
@@ -1,12 +1,21 @@
+import time
+import logging
+
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Table, Column, Integer, ForeignKey, String, Enum, CheckConstraint, UniqueConstraint, Boolean, Float
-from sqlalchemy.orm import relationship
+from sqlalchemy import Table, Column, Integer, ForeignKey, String, Enum, CheckConstraint, UniqueConstraint, Boolean, Float, \
+    LargeBinary, MetaData
+from sqlalchemy import func, inspect
+from sqlalchemy.orm import relationship, deferred, object_session
 
 from . import types
+from . import storage
 
 # setup classes for data holding
 Base = declarative_base()
 
+# slices (or chunks) fetched per query by Coordinate.get_slices, keeps the bound parameters well below sqlites limit
+SLICE_BATCH_SIZE = 300
+
 
 class Genome(Base):
     __tablename__ = 'genome'
@@ -30,24 +39,159 @@ class Coordinate(Base):
     __tablename__ = 'coordinate'
 
     id = Column(Integer, primary_key=True, index=True)
-    sequence = Column(String)
+    # only set when stored as plain text (sequence_storage None or 'plain'), and only loaded on access
+    sequence = deferred(Column(String))
     length = Column(Integer)
     seqid = Column(String, nullable=False)
-    sha1 = Column(String)
+    sha1 = Column(String, index=True)
+    sequence_storage = Column(Enum(types.SequenceStorage))
+    chunk_size = Column(Integer)
     genome_id = Column(Integer, ForeignKey('genome.id'), nullable=False)
     genome = relationship('Genome', back_populates='coordinates')
+    # set if the identical sequence was already stored for another coordinate, which then holds it
+    sequence_source_id = Column(Integer, ForeignKey('coordinate.id'))
+    sequence_source = relationship('Coordinate', remote_side=[id])
+    # the fasta file the sequence was read from
+    sequence_file_id = Column(Integer, ForeignKey('sequence_file.id'))
+    sequence_file = relationship('SequenceFile', back_populates='coordinates')
 
     features = relationship('Feature', back_populates='coordinate')
+    sequence_chunks = relationship('SequenceChunk', back_populates='coordinate', lazy='dynamic')
 
     __table_args__ = (
         UniqueConstraint('genome_id', 'seqid', name='unique_coords_per_genome'),
         CheckConstraint('length >= 0', name='check_positive_length'),
     )
 
+    @property
+    def is_chunked(self):
+        return self.sequence_storage not in [None, types.SequenceStorage.plain]
+
+    def get_slice(self, start, end):
+        """Returns the + strand sequence from start to end (exclusive), negative positions are
+        treated as 0. For chunked storage, only the chunks overlapping start:end are decompressed."""
+        if self.sequence_source is not None:
+            return self.sequence_source.get_slice(start, end)
+        start, end = max(start, 0), min(max(end, 0), self.length)
+        if not self.is_chunked:
+            return self._get_plain_slice(start, end)
+        if start >= end:
+            return ''
+        first, last = storage.chunk_positions(start, end, self.chunk_size)
+        chunks = (self.sequence_chunks
+                      .filter(SequenceChunk.position >= first)
+                      .filter(SequenceChunk.position <= last)
+                      .order_by(SequenceChunk.position))
+        seq = ''.join([chunk.decode() for chunk in chunks])
+        offset = first * self.chunk_size
+        return seq[(start - offset):(end - offset)]
+
+    def _get_plain_slice(self, start, end):
+        """slices in sql with substr(), unless the sequence is already loaded (or not yet in the db)"""
+        session = object_session(self)
+        if session is None or 'sequence' not in inspect(self).unloaded:
+            return self.sequence[start:end]
+        if start >= end:
+            return ''
+        return (session.query(func.substr(Coordinate.sequence, start + 1, end - start))
+                       .filter(Coordinate.id == self.id)
+                       .scalar())
+
+    def get_slices(self, ranges):
+        """Like get_slice for each (start, end) in ranges, but with a few batched queries for all
+        of them. Meant for many short slices, each chunk needed is only decompressed once."""
+        if self.sequence_source is not None:
+            return self.sequence_source.get_slices(ranges)
+        ranges = [(max(start, 0), min(max(end, 0), self.length)) for start, end in ranges]
+        if not self.is_chunked:
+            return self._get_plain_slices(ranges)
+        needed = [storage.chunk_positions(start, end, self.chunk_size) for start, end in ranges]
+        positions = sorted({p for (start, end), (first, last) in zip(ranges, needed) if start < end
+                            for p in range(first, last + 1)})
+        decoded = {}
+        for i in range(0, len(positions), SLICE_BATCH_SIZE):
+            chunks = self.sequence_chunks.filter(SequenceChunk.position.in_(positions[i:i + SLICE_BATCH_SIZE]))
+            decoded.update({chunk.position: chunk.decode() for chunk in chunks})
+        slices = []
+        for (start, end), (first, last) in zip(ranges, needed):
+            if start >= end:
+                slices.append('')
+                continue
+            seq = ''.join([decoded[p] for p in range(first, last + 1)])
+            offset = first * self.chunk_size
+            slices.append(seq[(start - offset):(end - offset)])
+        return slices
+
+    def _get_plain_slices(self, ranges):
+        """as _get_plain_slice. sqlite pages through a long value up to the position on every substr(),
+        so the slices are read with incremental blob I/O where available (python >= 3.11), which seeks
+        directly. Otherwise with up to SLICE_BATCH_SIZE substr() per query."""
+        session = object_session(self)
+        if session is None or 'sequence' not in inspect(self).unloaded:
+            return [self.sequence[start:end] for start, end in ranges]
+        dbapi_connection = session.connection().connection
+        if hasattr(dbapi_connection, 'blobopen'):
+            slices = []
+            with dbapi_connection.blobopen(Coordinate.__tablename__, 'sequence', self.id, readonly=True) as blob:
+                for start, end in ranges:
+                    if start >= end:
+                        slices.append('')
+                        continue
+                    blob.seek(start)
+                    slices.append(blob.read(end - start).decode())
+            return slices
+        slices = []
+        for i in range(0, len(ranges), SLICE_BATCH_SIZE):
+            columns = [func.substr(Coordinate.sequence, start + 1, max(end - start, 0))
+                       for start, end in ranges[i:i + SLICE_BATCH_SIZE]]
+            slices += session.query(*columns).filter(Coordinate.id == self.id).one()
+        return slices
+
+    def get_sequence(self):
+        return self.get_slice(0, self.length)
+
     def __repr__(self):
         return '<Coordinate {}, seqid: {}, len: {}>'.format(self.id, self.seqid, self.length)
 
 
+class SequenceFile(Base):
+    __tablename__ = 'sequence_file'
+    # a fasta file as it was on import, so that importing it again unchanged can skip reading it
+
+    id = Column(Integer, primary_key=True)
+    path = Column(String, nullable=False)
+    size = Column(Integer, nullable=False)
+    mtime = Column(Float, nullable=False)
+
+    coordinates = relationship('Coordinate', back_populates='sequence_file')
+
+    def __repr__(self):
+        return '<SequenceFile {}, path: {}, size: {}>'.format(self.id, self.path, self.size)
+
+
+class SequenceChunk(Base):
+    __tablename__ = 'sequence_chunk'
+    # fixed size pieces of a Coordinates sequence, each compressed on its own
+
+    id = Column(Integer, primary_key=True)
+    position = Column(Integer, nullable=False)  # covers sequence[position * chunk_size:(position + 1) * chunk_size]
+    encoding = Column(Enum(types.SequenceStorage), nullable=False)
+    data = Column(LargeBinary, nullable=False)
+    coordinate_id = Column(Integer, ForeignKey('coordinate.id'), nullable=False)
+    coordinate = relationship('Coordinate', back_populates='sequence_chunks')
+
+    __table_args__ = (
+        UniqueConstraint('coordinate_id', 'position', name='unique_chunk_positions'),
+    )
+
+    def decode(self):
+        return storage.decode_chunk(self.data, self.encoding.value)
+
+    def __repr__(self):
+        return '<SequenceChunk {}, coordinate: {}, position: {}, encoding: {}>'.format(
+            self.id, self.coordinate_id, self.position, self.encoding.value)
+
+
 class SuperLocus(Base):
     __tablename__ = 'super_locus'
     # normally a loci, some times a short list of loci for "trans splicing"
@@ -93,8 +237,14 @@ class Transcript(Base):
 
     type = Column(Enum(types.TranscriptLevelAll))
     longest = Column(Boolean)
-
-    super_locus_id = Column(Integer, ForeignKey('super_locus.id'), nullable=False)
+    # summed lengths of the transcribed, exonic, coding exonic and untranslated exonic ranges,
+    # filled in on import (NULL for transcripts added otherwise)
+    pre_mrna_length = Column(Integer)
+    mature_length = Column(Integer)
+    cds_length = Column(Integer)
+    utr_length = Column(Integer)
+
+    super_locus_id = Column(Integer, ForeignKey('super_locus.id'), nullable=False, index=True)
     super_locus = relationship('SuperLocus', back_populates='transcripts')
 
     transcript_pieces = relationship('TranscriptPiece', back_populates='transcript')
@@ -138,7 +288,7 @@ class Protein(Base):
     id = Column(Integer, primary_key=True, index=True)
     given_name = Column(String)
     # type can only be 'protein' so far as I know..., so skipping
-    super_locus_id = Column(Integer, ForeignKey('super_locus.id'), nullable=False)
+    super_locus_id = Column(Integer, ForeignKey('super_locus.id'), nullable=False, index=True)
     super_locus = relationship('SuperLocus', back_populates='proteins')
 
     features = relationship('Feature', secondary=association_protein_to_feature,
@@ -214,3 +364,122 @@ class Feature(Base):
                 plus=self.is_plus_strand, phase=self.phase, givenid=self.given_name
             )
         return s
+
+
+##### schema upgrades #####
+# dbs written by earlier versions lack the columns and indexes added since. All added columns are nullable,
+# with NULL read as 'not stored' (e.g. plain sequence storage, lengths not precomputed). Importing into such
+# a db adds them in place (upgrade_schema), reading it leaves it as is (add_missing_column_views).
+def add_missing_column_views(dbapi_connection, connection_record=None):
+    """For a 'connect' event listener of readers. Every table lacking columns of the current schema
+    is shadowed, for this connection only, by a temporary view adding them as NULL. The db itself is
+    not written to, so this works on read only dbs as well."""
+    cursor = dbapi_connection.cursor()
+    for table in Base.metadata.sorted_tables:
+        existing = [row[1] for row in cursor.execute('PRAGMA main.table_info("{}")'.format(table.name))]
+        missing = [column.name for column in table.columns if column.name not in existing]
+        if existing and missing:
+            cursor.execute('CREATE TEMP VIEW IF NOT EXISTS "{0}" AS SELECT *, {1} FROM main."{0}"'.format(
+                table.name, ', '.join(['NULL AS "{}"'.format(name) for name in missing])))
+    cursor.close()
+
+
+def add_missing_columns(connection):
+    """adds the columns of the current schema that the existing tables lack"""
+    inspector = inspect(connection)
+    quote = connection.dialect.identifier_preparer.quote
+    existing_tables = inspector.get_table_names()
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = set([column['name'] for column in inspector.get_columns(table.name)])
+        for column in table.columns:
+            if column.name not in existing:
+                connection.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                    quote(table.name), quote(column.name), column.type.compile(dialect=connection.dialect)))
+
+
+def missing_indexes(connection, tables=None):
+    """the indexes of the current schema (or just those of tables) that the existing tables lack"""
+    inspector = inspect(connection)
+    existing_tables = inspector.get_table_names()
+    if tables is None:
+        tables = Base.metadata.sorted_tables
+    missing = []
+    for table in tables:
+        if table.name not in existing_tables:
+            continue
+        # of main, a reader might shadow the table with a temporary view (add_missing_column_views)
+        existing = set([index['name'] for index in inspector.get_indexes(table.name, schema='main')])
+        missing += [index for index in table.indexes if index.name not in existing]
+    return missing
+
+
+def create_missing_indexes(connection, tables=None):
+    """creates the indexes of the current schema (or just those of tables) that are not in the db yet.
+    Can take a while on large dbs, so this is only done on import or by scripts/upgrade_db.py"""
+    quote = connection.dialect.identifier_preparer.quote
+    for index in missing_indexes(connection, tables):
+        start = time.time()
+        connection.execute('CREATE {}INDEX IF NOT EXISTS {} ON {} ({})'.format(
+            'UNIQUE ' if index.unique else '', quote(index.name), quote(index.table.name),
+            ', '.join([quote(column.name) for column in index.columns])))
+        logging.info('created index {} in {:.2f}s'.format(index.name, time.time() - start))
+
+
+def warn_about_missing_indexes(engine):
+    """for readers, which do not change the db"""
+    with engine.connect() as conn:
+        missing = [index.name for index in missing_indexes(conn)]
+    if missing:
+        logging.warning('the db lacks the indexes {}, which makes reading it slower. They can be added with '
+                        'scripts/upgrade_db.py'.format(', '.join(missing)))
+
+
+def upgrade_schema(engine):
+    """creates missing tables, adds missing columns and creates missing indexes, so a db of an earlier
+    version can be used as is"""
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        add_missing_columns(conn)
+        create_missing_indexes(conn)
+
+
+##### spatial index of features #####
+# a sqlite R*Tree over (coordinate, strand, [min, max] position) of every feature, filled on import
+# and used to find what overlaps a region without scanning whole coordinates. It is a virtual
+# table, so it is managed here and not by the metadata above.
+FEATURE_RTREE = 'feature_rtree'
+# for building queries only, kept out of Base.metadata so create_all leaves it alone
+feature_rtree = Table(FEATURE_RTREE, MetaData(),
+    Column('id', Integer, primary_key=True),
+    Column('min_coordinate', Integer),
+    Column('max_coordinate', Integer),
+    Column('min_strand', Integer),
+    Column('max_strand', Integer),
+    Column('lower', Integer),
+    Column('upper', Integer)
+)
+
+
+def create_feature_rtree(connection):
+    connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS {} USING rtree_i32('
+                       'id, min_coordinate, max_coordinate, min_strand, max_strand, '
+                       'lower, upper)'.format(FEATURE_RTREE))
+
+
+def fill_feature_rtree(connection, genome_id=None):
+    """(re-)indexes all features on the coordinates of genome_id, or of all genomes if None"""
+    query = ('INSERT OR REPLACE INTO {} '
+             'SELECT feature.id, feature.coordinate_id, feature.coordinate_id, '
+             'feature.is_plus_strand, feature.is_plus_strand, '
+             'min(feature.start, feature."end"), max(feature.start, feature."end") '
+             'FROM feature JOIN coordinate ON feature.coordinate_id = coordinate.id'.format(FEATURE_RTREE))
+    if genome_id is None:
+        connection.execute(query)
+    else:
+        connection.execute(query + ' WHERE coordinate.genome_id = ?', (genome_id,))
+
+
+def has_feature_rtree(connection):
+    return FEATURE_RTREE in inspect(connection).get_table_names()
@@ -0,0 +1,104 @@
+import zlib
+import struct
+import numpy
+
+from . import types
+
+
+DEFAULT_CHUNK_SIZE = 2 ** 16
+
+##### 2-bit packing #####
+# ACGT are packed to two bits per base, N is stored as a table of (start, length) runs and takes
+# the code of A in the packed data. Any other character makes a chunk fall back to zlib.
+TWO_BIT_BASES = numpy.frombuffer(b'ACGT', dtype=numpy.uint8)
+TWO_BIT_CODES = numpy.zeros(256, dtype=numpy.uint8)
+TWO_BIT_PACKABLE = numpy.zeros(256, dtype=bool)
+for code, base in enumerate(b'ACGT'):
+    TWO_BIT_CODES[base] = code
+    TWO_BIT_PACKABLE[base] = True
+TWO_BIT_PACKABLE[ord('N')] = True
+TWO_BIT_HEADER = struct.Struct('<II')  # length, number of N runs
+
+
+def two_bit_packable(chunk):
+    return bool(TWO_BIT_PACKABLE[numpy.frombuffer(chunk.encode('ascii'), dtype=numpy.uint8)].all())
+
+
+def encode_two_bit(chunk):
+    bases = numpy.frombuffer(chunk.encode('ascii'), dtype=numpy.uint8)
+    # start and end of every run of Ns
+    is_n = numpy.concatenate(([False], bases == ord('N'), [False]))
+    edges = numpy.flatnonzero(is_n[1:] != is_n[:-1])
+    n_starts, n_ends = edges[::2], edges[1::2]
+    n_runs = numpy.stack([n_starts, n_ends - n_starts], axis=1).astype('<u4')
+
+    codes = TWO_BIT_CODES[bases]
+    codes = numpy.concatenate((codes, numpy.zeros(-len(codes) % 4, dtype=numpy.uint8))).reshape(-1, 4)
+    packed = (codes[:, 0] << 6) | (codes[:, 1] << 4) | (codes[:, 2] << 2) | codes[:, 3]
+    return TWO_BIT_HEADER.pack(len(bases), len(n_runs)) + n_runs.tobytes() + packed.tobytes()
+
+
+def decode_two_bit(data):
+    length, n_n_runs = TWO_BIT_HEADER.unpack_from(data)
+    n_runs = numpy.frombuffer(data, dtype='<u4', count=2 * n_n_runs,
+                              offset=TWO_BIT_HEADER.size).reshape(-1, 2)
+    packed = numpy.frombuffer(data, dtype=numpy.uint8, offset=TWO_BIT_HEADER.size + n_runs.nbytes)
+    codes = numpy.stack([packed >> 6, (packed >> 4) & 3, (packed >> 2) & 3, packed & 3], axis=1)
+    bases = TWO_BIT_BASES[codes.ravel()[:length]]
+    for start, run_length in n_runs:
+        bases[start:(start + run_length)] = ord('N')
+    return bases.tobytes().decode('ascii')
+
+
+##### chunks #####
+
+def encode_chunk(chunk, storage):
+    """returns (encoding, data) for one chunk of sequence, with encoding being the storage type
+    that was actually used"""
+    if storage == types.TWO_BIT and two_bit_packable(chunk):
+        return types.TWO_BIT, encode_two_bit(chunk)
+    elif storage in [types.TWO_BIT, types.ZLIB]:
+        return types.ZLIB, zlib.compress(chunk.encode('ascii'))
+    else:
+        raise ValueError('cannot store sequence chunks as {}'.format(storage))
+
+
+def decode_chunk(data, encoding):
+    if encoding == types.TWO_BIT:
+        return decode_two_bit(data)
+    elif encoding == types.ZLIB:
+        return zlib.decompress(data).decode('ascii')
+    else:
+        raise ValueError('unknown sequence chunk encoding {}'.format(encoding))
+
+
+def encode_chunks(sequence, storage, chunk_size=DEFAULT_CHUNK_SIZE):
+    """yields (position, encoding, data) for each consecutive chunk_size piece of sequence"""
+    for position, i in enumerate(range(0, len(sequence), chunk_size)):
+        encoding, data = encode_chunk(sequence[i:(i + chunk_size)], storage)
+        yield position, encoding, data
+
+
+def encode_blocks(blocks, storage, chunk_size=DEFAULT_CHUNK_SIZE):
+    """as encode_chunks, for a sequence coming as ascii bytes blocks of any size"""
+    for position, chunk in enumerate(rechunk(blocks, chunk_size)):
+        encoding, data = encode_chunk(chunk, storage)
+        yield position, encoding, data
+
+
+def rechunk(blocks, chunk_size=DEFAULT_CHUNK_SIZE):
+    """consecutive chunk_size pieces (as str) of the sequence in blocks"""
+    pending = bytearray()
+    for block in blocks:
+        pending += block
+        n_full = len(pending) - len(pending) % chunk_size
+        for i in range(0, n_full, chunk_size):
+            yield pending[i:(i + chunk_size)].decode('ascii')
+        del pending[:n_full]
+    if pending:
+        yield pending.decode('ascii')
+
+
+def chunk_positions(start, end, chunk_size):
+    """first and last chunk position needed for the (clamped) slice start:end"""
+    return start // chunk_size, (end - 1) // chunk_size
@@ -82,6 +82,28 @@ UsefulGFFFeatures = join_to_enum('UsefulGFFFeatures', SuperLocusAll, TranscriptL
                                  UsefulGFFSequenceFeatures)
 AllKnownGFFFeatures = join_to_enum('AllKnownGFFFeatures', IgnorableGFFFeatures, UsefulGFFFeatures)
 
+# what the importer makes of each known gff type
+GFF_SUPER_LOCUS = 'gff_super_locus'
+GFF_TRANSCRIPT = 'gff_transcript'
+GFF_EXON = 'gff_exon'
+GFF_CDS = 'gff_cds'
+GFF_IGNORABLE = 'gff_ignorable'
+
+
+def classify_enum_values(*enums_and_categories):
+    """{enum value: category} from pairs of (enum, category)"""
+    out = {}
+    for enum_, category in enums_and_categories:
+        for x in enum_:
+            out[x.value] = category
+    return out
+
+
+GFF_TYPE_CATEGORIES = classify_enum_values((SuperLocusAll, GFF_SUPER_LOCUS),
+                                           (TranscriptLevelAll, GFF_TRANSCRIPT),
+                                           (IgnorableGFFFeatures, GFF_IGNORABLE))
+GFF_TYPE_CATEGORIES.update({EXON: GFF_EXON, CDS: GFF_CDS})
+
 
 ########
 # Geenuff
@@ -109,3 +131,9 @@ Errors = make_enum('Errors', MISSING_UTR_5P, MISSING_UTR_3P, EMPTY_SUPER_LOCUS,
                    TOO_SHORT_INTRON, SL_OVERLAP_ERROR)
 
 GeenuffFeature = join_to_enum('GeenuffFeature', GeenuffSequenceFeature, Errors)
+
+# Sequence storage
+PLAIN = 'plain'  # whole sequence as one string in Coordinate.sequence
+ZLIB = 'zlib'  # fixed size, zlib compressed SequenceChunks
+TWO_BIT = 'two_bit'  # fixed size SequenceChunks packed to 2 bits per base plus a table of N runs
+SequenceStorage = make_enum('SequenceStorage', PLAIN, ZLIB, TWO_BIT)
@@ -1,5 +1,7 @@
 import os
+import shutil
 import pytest
+from sqlalchemy import create_engine, inspect
 from ..applications.importer import ImportController
 from ..applications.exporters.sequence import FastaExportController
 from ..applications.exporters.lengths import LengthExportController
@@ -9,6 +11,13 @@ from geenuff.base import orm, types
 import json
 
 EXPORTING_DB = 'testdata/exporting.sqlite3'
+OLD_SCHEMA_DB = 'testdata/exporting_old_schema.sqlite3'
+# the columns and tables added to the schema after dbs were first written
+ADDED_COLUMNS = {'coordinate': ['sequence_storage', 'chunk_size', 'sequence_source_id', 'sequence_file_id'],
+                 'transcript': ['pre_mrna_length', 'mature_length', 'cds_length', 'utr_length']}
+ADDED_TABLES = ['sequence_chunk', 'sequence_file', orm.FEATURE_RTREE]
+ADDED_INDEXES = {'coordinate': 'ix_coordinate_sha1', 'transcript': 'ix_transcript_super_locus_id',
+                 'protein': 'ix_protein_super_locus_id'}
 
 
 @pytest.fixture(scope="module", autouse=True)
@@ -24,6 +33,30 @@ def prepare_and_cleanup():
     os.remove(EXPORTING_DB)
 
 
+def mk_old_schema_db():
+    """copies EXPORTING_DB into a db as an earlier version would have written it (without the added
+    columns, tables and indexes)"""
+    shutil.copy(EXPORTING_DB, OLD_SCHEMA_DB)
+    engine = create_engine('sqlite:///' + OLD_SCHEMA_DB)
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in ADDED_TABLES:
+            conn.execute('DROP TABLE {}'.format(table))
+        for table, added in ADDED_COLUMNS.items():
+            kept = [c for c in inspector.get_columns(table) if c['name'] not in added]
+            conn.execute('CREATE TABLE old_{} ({})'.format(table, ', '.join(
+                ['{} {}{}'.format(c['name'], c['type'], ' PRIMARY KEY' if c['primary_key'] else '')
+                 for c in kept])))
+            names = ', '.join([c['name'] for c in kept])
+            conn.execute('INSERT INTO old_{0} ({1}) SELECT {1} FROM {0}'.format(table, names))
+            conn.execute('DROP TABLE {}'.format(table))
+            conn.execute('ALTER TABLE old_{0} RENAME TO {0}'.format(table))
+        for index in ADDED_INDEXES.values():
+            conn.execute('DROP INDEX IF EXISTS {}'.format(index))
+    engine.dispose()
+    return 'sqlite:///' + OLD_SCHEMA_DB
+
+
 def seq_len_controllers(mode, longest=False):
     econtroller = FastaExportController(db_path_in='sqlite:///' + EXPORTING_DB, longest=longest)
     econtroller.prep_ranges(range_function=MODES[mode], genomes=None, exclude=None)
@@ -457,3 +490,406 @@ def test_get_json_feature():
     assert len(meh[0]['super_loci']) == 1
     print(json.dumps(meh, indent=2))
     # todo, slightly more thorough testing
+
+
+def test_sequence_cache():
+    # room for the 4000bp coordinate, but not for both
+    controller = FastaExportController(db_path_in='sqlite:///' + EXPORTING_DB, sequence_cache_bytes=5000)
+    cache = controller.sequence_cache
+    coords = controller.session.query(orm.Coordinate).order_by(orm.Coordinate.length.desc()).all()
+    assert [c.length for c in coords] == [4000, 3000]
+    long_coord, short_coord = coords
+
+    assert cache.get_slice(long_coord.id, 10, 20) == long_coord.get_slice(10, 20)
+    assert list(cache.sequences) == [long_coord.id]
+    # pulling in the second coordinate evicts the least recently used one
+    assert cache.get_slice(short_coord.id, -5, 3500) == short_coord.get_slice(0, 3000)
+    assert list(cache.sequences) == [short_coord.id]
+    assert cache.n_bytes == 3000
+
+    # sequences larger than the whole cache are sliced from the db and never cached
+    controller.sequence_cache.max_bytes = 100
+    assert cache.get_slice(long_coord.id, 0, 50) == long_coord.get_slice(0, 50)
+    assert long_coord.id not in cache.sequences
+
+
+def test_stream_fa():
+    fa_out = 'testdata/streamed.fa'
+    controller = FastaExportController(db_path_in='sqlite:///' + EXPORTING_DB)
+    controller.stream_fa('', '', MODES['pre-mRNA'], fa_out)
+    with open(fa_out) as f:
+        streamed = f.read()
+    os.remove(fa_out)
+    controller = FastaExportController(db_path_in='sqlite:///' + EXPORTING_DB)
+    controller.prep_ranges('', '', MODES['pre-mRNA'])
+    assert streamed == ''.join(controller.fmt_seq(grp) + '\n' for grp in controller.export_ranges)
+    assert streamed.startswith('>')
+
+
+def test_super_locus_loader():
+    from sqlalchemy import event
+    from ..applications.exporter import SuperLocusLoader
+    controller = FastaExportController(db_path_in='sqlite:///' + EXPORTING_DB)
+    n_queries = [0]
+
+    @event.listens_for(controller.engine, 'before_cursor_execute')
+    def count_queries(*args):
+        n_queries[0] += 1
+
+    coords = controller.session.query(orm.Coordinate).all()
+    loader = SuperLocusLoader(controller.session)
+    n_loaded = 0
+    for coord in coords:
+        super_loci = loader.load(coord.id)
+        n_queries_loaded = n_queries[0]
+        for super_locus in super_loci:
+            for transcript in super_locus.transcripts:
+                assert transcript.super_locus is super_locus
+                for piece in transcript.transcript_pieces:
+                    assert piece.transcript is transcript
+                    for feature in piece.features:
+                        assert piece in feature.transcript_pieces
+        # walking the tree did not need the db
+        assert n_queries[0] == n_queries_loaded
+        n_loaded += len(super_loci)
+    assert n_loaded == controller.session.query(orm.SuperLocus).join(orm.Transcript).distinct().count()
+
+
+def test_super_locus_loader_batches_and_proteins():
+    from sqlalchemy import event
+    from ..applications.exporter import SuperLocusLoader
+    controller = JsonExportController(db_path_in='sqlite:///' + EXPORTING_DB)
+    coord = controller.session.query(orm.Coordinate).filter(
+        orm.Coordinate.seqid == 'Chr1:195000-199000').one()
+    expect = SuperLocusLoader(controller.session).load(coord.id)
+    loader = SuperLocusLoader(controller.session, batch_size=1, load_proteins=True)
+    n_queries = [0]
+
+    @event.listens_for(controller.engine, 'before_cursor_execute')
+    def count_queries(*args):
+        n_queries[0] += 1
+
+    batches = list(loader.gen_batches(coord.id))
+    assert [len(b) for b in batches] == [1] * len(expect)
+    assert [b[0] for b in batches] == expect
+    # ordering query, then the same number of queries for every batch
+    assert (n_queries[0] - 1) % len(batches) == 0
+    n_queries_loaded = n_queries[0]
+    protein_ids = set()
+    for super_locus in expect:
+        for transcript in super_locus.transcripts:
+            for feature in TranscriptJsonable(transcript).sorted_features():
+                protein_ids.add(FeatureJsonable(feature).protein_ids(transcript))
+        assert all(protein.super_locus is super_locus for protein in super_locus.proteins)
+    assert n_queries[0] == n_queries_loaded
+    assert protein_ids - {None}
+
+
+def test_range_maker_cache():
+    from ..applications.exporter import RangeMaker
+    controller = FastaExportController(db_path_in='sqlite:///' + EXPORTING_DB)
+    transcript = controller.session.query(orm.Transcript).first()
+    range_maker = RangeMaker(transcript)
+    n_walks = [0]
+    walk = range_maker.feature_piece_pairs
+
+    def counted_walk():
+        n_walks[0] += 1
+        return walk()
+
+    range_maker.feature_piece_pairs = counted_walk
+    exons = [x.ranges[0] for x in range_maker.exonic_ranges()]
+    assert range_maker.sum_exonic_lengths() == sum(abs(r.end - r.start) for r in exons)
+    range_maker.mature_RNA()
+    range_maker.cds_exonic_ranges()
+    range_maker.untranslated_exonic_ranges()
+    assert n_walks[0] == 1
+    # changing returned lists does not affect the cache
+    range_maker.mature_RNA()[0].ranges.clear()
+    assert [x.ranges[0] for x in range_maker.exonic_ranges()] == exons
+    range_maker.invalidate_cache()
+    assert [x.ranges[0] for x in range_maker.exonic_ranges()] == exons
+    assert n_walks[0] == 2
+
+
+@pytest.mark.parametrize('mode', ['pre-mRNA', 'mRNA', 'CDS'])
+@pytest.mark.parametrize('longest', [False, True])
+def test_precomputed_lengths(mode, longest):
+    from ..applications.exporters.lengths import PRECOMPUTED_LENGTHS
+    lcontroller = LengthExportController(db_path_in='sqlite:///' + EXPORTING_DB, longest=longest)
+    assert mode in PRECOMPUTED_LENGTHS
+    assert lcontroller.has_precomputed_lengths()
+    lcontroller.prep_lengths(genomes=None, exclude=None, mode=mode)
+    precomputed = [(seqid, length) for seqid, length, _ in lcontroller.export_lengths]
+    _, lcontroller = seq_len_controllers(mode, longest=longest)
+    from_ranges = list(lcontroller.gen_lengths())
+    assert precomputed
+    assert sorted(precomputed) == sorted(from_ranges)
+
+
+@pytest.mark.parametrize('mode', ['pre-mRNA', 'mRNA', 'CDS'])
+def test_lengths_of_old_schema(mode):
+    """lengths are computed from the ranges when the db predates the precomputed lengths"""
+    old_db = mk_old_schema_db()
+    try:
+        lcontroller = LengthExportController(db_path_in=old_db)
+        assert not lcontroller.has_precomputed_lengths()
+        lcontroller.prep_lengths(genomes=None, exclude=None, mode=mode)
+        from_ranges = [(seqid, length) for seqid, length, _ in lcontroller.export_lengths]
+        lcontroller = LengthExportController(db_path_in='sqlite:///' + EXPORTING_DB)
+        assert lcontroller.has_precomputed_lengths()
+        lcontroller.prep_lengths(genomes=None, exclude=None, mode=mode)
+        precomputed = [(seqid, length) for seqid, length, _ in lcontroller.export_lengths]
+        assert from_ranges
+        assert sorted(from_ranges) == sorted(precomputed)
+    finally:
+        os.remove(OLD_SCHEMA_DB)
+
+
+def test_length_stats_by_genome():
+    stats_out = 'testdata/length_stats.tsv'
+    lcontroller = LengthExportController(db_path_in='sqlite:///' + EXPORTING_DB)
+    lcontroller.stream_length_stats(None, None, 'exons', stats_out, by_genome=True)
+    with open(stats_out) as f:
+        by_genome = [line.rstrip('\n').split('\t') for line in f]
+    lcontroller = LengthExportController(db_path_in='sqlite:///' + EXPORTING_DB)
+    lcontroller.prep_ranges(None, None, MODES['exons'])
+    lcontroller.write_length_stats(stats_out)
+    with open(stats_out) as f:
+        overall = [line.rstrip('\n').split('\t') for line in f]
+    os.remove(stats_out)
+
+    lengths = [lcontroller.get_length(grp) for grp in lcontroller.export_ranges]
+    # a single genome, so the same stats, just prefixed with the species
+    assert [line[0] for line in by_genome] == ['dummy'] * len(overall)
+    assert [line[1:] for line in by_genome] == overall
+    overall = dict(overall)
+    assert int(overall['count']) == len(lengths)
+    assert int(overall['total']) == sum(lengths)
+    assert int(overall['longest']) == max(lengths)
+
+
+def test_nx_grid():
+    from ..applications.exporters.lengths import nx, fmt_keys, parse_x_grid
+    x_vals = parse_x_grid('1-99')
+    assert len(x_vals) == 99 and x_vals[28] == 0.29
+    lengths = [5, 1, 10, 3, 3, 8, 2]
+    descending = sorted(lengths, reverse=True)
+    for x, n in nx(lengths, x_vals).items():
+        # the length at which at least x of the total is reached
+        i = next(i for i in range(len(descending)) if sum(descending[:i + 1]) >= x * sum(lengths))
+        assert n == descending[i]
+    labelled = fmt_keys(nx(lengths, x_vals), pfx='N', sfx='')
+    assert list(labelled)[28] == 'N29'
+    assert list(fmt_keys({0.125: 1}, pfx='N', sfx='')) == ['N12.5']
+    assert parse_x_grid('90,10,50') == [0.1, 0.5, 0.9]
+    with pytest.raises(ValueError):
+        parse_x_grid('0-101')
+
+
+def test_old_schema_export(caplog):
+    """dbs of an earlier version are read as they are (also read only), lacking columns read as NULL, and
+    the sequence (stored plain) exports"""
+    old_db = mk_old_schema_db()
+    try:
+        with open(OLD_SCHEMA_DB, 'rb') as f:
+            before = f.read()
+        expected = FastaExportController(db_path_in='sqlite:///' + EXPORTING_DB)
+        read_only = 'sqlite:///file:{}?mode=ro&uri=true'.format(OLD_SCHEMA_DB)
+        for db in [old_db, read_only]:
+            controller = FastaExportController(db_path_in=db)
+            coordinate = controller.session.query(orm.Coordinate).first()
+            assert coordinate.sequence_storage is None and not coordinate.is_chunked
+            for c in [expected, controller]:
+                c.prep_ranges(range_function=MODES['mRNA'], genomes=None, exclude=None)
+            assert controller.export_ranges
+            for grp, expected_grp in zip(controller.export_ranges, expected.export_ranges):
+                assert controller.get_seq(grp) == expected.get_seq(expected_grp)
+            controller.session.close()
+            controller.engine.dispose()
+        with open(OLD_SCHEMA_DB, 'rb') as f:
+            assert f.read() == before
+        engine = create_engine(old_db)
+        columns = [c['name'] for c in inspect(engine).get_columns('coordinate')]
+        assert not set(ADDED_COLUMNS['coordinate']) & set(columns)
+        for table, index in ADDED_INDEXES.items():
+            assert index not in [i['name'] for i in inspect(engine).get_indexes(table)]
+            assert index in caplog.text
+        # until explicitly upgraded
+        orm.upgrade_schema(engine)
+        for table, index in ADDED_INDEXES.items():
+            assert index in [i['name'] for i in inspect(engine).get_indexes(table)]
+        caplog.clear()
+        FastaExportController(db_path_in=old_db)
+        assert 'lacks the indexes' not in caplog.text
+    finally:
+        os.remove(OLD_SCHEMA_DB)
+
+
+def test_old_schema_import():
+    """appending to a db of an earlier version upgrades it and references the sequences it holds"""
+    old_db = mk_old_schema_db()
+    window = ('dummy', 'Chr1:195000-199000', 1, 3900, True)
+    try:
+        reader = JsonExportController(db_path_in=old_db)
+        assert not reader.has_feature_index
+        scanned = reader.coordinate_range_to_jsonable(*window)
+        assert scanned
+        controller = ImportController(database_path=OLD_SCHEMA_DB)
+        controller.add_genome('testdata/exporting.fa', 'testdata/exporting.gff3', clean_gff=True,
+                              genome_args={'species': 'again'})
+        controller.finalize()
+        assert 'ix_coordinate_sha1' in [i['name'] for i in inspect(controller.engine).get_indexes('coordinate')]
+        old = controller.session.query(orm.Genome).filter(orm.Genome.species == 'dummy').one()
+        new = controller.session.query(orm.Genome).filter(orm.Genome.species == 'again').one()
+        assert len(new.coordinates) == len(old.coordinates)
+        for coordinate in new.coordinates:
+            assert coordinate.sequence_source in old.coordinates
+            assert coordinate.get_sequence() == coordinate.sequence_source.sequence
+        # the feature index, created by the append, covers the genome that was already there
+        reader = JsonExportController(db_path_in=old_db)
+        assert reader.has_feature_index
+        assert reader.coordinate_range_to_jsonable(*window) == scanned
+    finally:
+        os.remove(OLD_SCHEMA_DB)
+
+
+def test_json_feature_index():
+    controller = JsonExportController(db_path_in='sqlite:///' + EXPORTING_DB)
+    assert controller.has_feature_index
+    windows = [(1, 3900, True), (1, 3900, False), (3900, 1, False), (2000, 2100, True), (0, 10, True)]
+    for start, end, is_plus_strand in windows:
+        indexed = controller.coordinate_range_to_jsonable('dummy', seqid='Chr1:195000-199000',
+                                                          start=start, end=end,
+                                                          is_plus_strand=is_plus_strand)
+        # same result without the index
+        controller._has_feature_index = False
+        scanned = controller.coordinate_range_to_jsonable('dummy', seqid='Chr1:195000-199000',
+                                                          start=start, end=end,
+                                                          is_plus_strand=is_plus_strand)
+        controller._has_feature_index = None
+        assert indexed == scanned
+    # nothing for unknown species
+    assert controller.coordinate_range_to_jsonable('nope', 'Chr1:195000-199000', 1, 3900, True) == []
+
+
+def test_json_feature_index_order():
+    """super loci come in the same order with and without the feature index"""
+    db_path = 'testdata/dummyloci_json.sqlite3'
+    controller = ImportController(database_path='sqlite:///' + db_path, replace_db=True)
+    controller.add_genome('testdata/dummyloci.fa', 'testdata/dummyloci.gff', clean_gff=True,
+                          genome_args={'species': 'dummy'})
+    # a minus strand gene within another, so ordering by start and by lowest position differ
+    controller.add_genome('testdata/nested_minus.fa', 'testdata/nested_minus.gff3', clean_gff=False,
+                          genome_args={'species': 'nested'})
+    try:
+        controller = JsonExportController(db_path_in='sqlite:///' + db_path)
+        assert controller.has_feature_index
+        windows = [('dummy', '1', 1, 1801, True), ('dummy', '1', 300, 1700, True),
+                   ('dummy', '2', 1, 1755, True), ('dummy', '2', 1755, 1, False),
+                   ('dummy', '2', 1700, 1000, False), ('nested', 's1', 1200, 1, False)]
+        for species, seqid, start, end, is_plus_strand in windows:
+            coordinate = controller.get_coordinates(species, seqid)[0]
+            indexed = [sl.id for sl in controller.gen_window_super_loci(coordinate, start, end, is_plus_strand)]
+            controller._has_feature_index = False
+            scanned = [sl.id for sl in controller.gen_window_super_loci(coordinate, start, end, is_plus_strand)]
+            controller._has_feature_index = None
+            assert len(indexed) > 1
+            # the scan has all super loci of the coordinate, the index only those near the window
+            assert indexed == [sl_id for sl_id in scanned if sl_id in indexed]
+    finally:
+        os.remove(db_path)
+
+
+def test_region_server():
+    import threading
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
+    from urllib.parse import quote
+    from ..applications.region_server import make_server
+    server = make_server(EXPORTING_DB, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    try:
+        url = '{}/region/dummy/{}/1/3900/+'.format(base, quote('Chr1:195000-199000', safe=''))
+        for _ in range(2):
+            with urlopen(url) as response:
+                assert response.headers['Server-Timing'].startswith('region;dur=')
+                served = json.loads(response.read())
+        controller = JsonExportController(db_path_in='sqlite:///' + EXPORTING_DB)
+        assert served == controller.coordinate_range_to_jsonable('dummy', 'Chr1:195000-199000', 1, 3900,
+                                                                 True)
+        # another window of the same super locus is served from the cached one
+        url = '{}/region/dummy/{}/1500/2500/+'.format(base, quote('Chr1:195000-199000', safe=''))
+        with urlopen(url) as response:
+            served = json.loads(response.read())
+        assert served == controller.coordinate_range_to_jsonable('dummy', 'Chr1:195000-199000', 1500, 2500,
+                                                                 True)
+        with pytest.raises(HTTPError) as e:
+            urlopen('{}/region/dummy/nope/1/3900/+'.format(base))
+        assert e.value.code == 404
+        with urlopen(base + '/metrics') as response:
+            metrics = json.loads(response.read())
+        assert metrics['requests'] == 4
+        assert metrics['cache_misses'] == 1
+        assert metrics['cache_hits'] == 2
+        assert metrics['cached_super_loci'] == 1
+        assert metrics['max_ms'] >= metrics['p50_ms']
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_jsonable_spans():
+    controller = JsonExportController(db_path_in='sqlite:///' + EXPORTING_DB)
+    coords = controller.session.query(orm.Coordinate).all()
+    for sl in controller.session.query(orm.SuperLocus).all():
+        slh = SuperLocusJsonable(sl)
+        for coord in coords:
+            for start, end in [(1, 3900), (790, 3000), (1500, 1600), (3000, 1), (1600, 1500)]:
+                is_plus_strand = start < end
+                fhs = [fh for th in slh.transcript_handlers for fh in th.feature_handlers]
+                # transcript / super locus checks from the spans as from checking every feature
+                for handler, features in [(slh, fhs)] + [(th, th.feature_handlers)
+                                                         for th in slh.transcript_handlers]:
+                    assert handler.is_fully_contained(coord, start, end, is_plus_strand) == \
+                        all(fh.is_fully_contained(coord, start, end, is_plus_strand) for fh in features)
+                    assert handler.overlaps(coord, start, end, is_plus_strand) == \
+                        any(fh.overlaps(coord, start, end, is_plus_strand) for fh in features)
+
+    # the window independent part of the feature dicts is reused
+    th = slh.transcript_handlers[0]
+    fh = th.feature_handlers[0]
+    coord = controller.session.query(orm.Coordinate).get(fh.data.coordinate_id)
+    inside = fh.to_jsonable(fh.data, coord, fh.data.start, fh.data.end, fh.data.is_plus_strand, th.data)
+    outside = fh.to_jsonable(fh.data, coord, fh.data.start, fh.data.end, not fh.data.is_plus_strand,
+                             th.data)
+    assert inside['is_fully_contained'] and inside['overlaps']
+    assert not outside['is_fully_contained'] and not outside['overlaps']
+    assert {k: v for k, v in inside.items() if k not in ('is_fully_contained', 'overlaps')} == \
+        {k: v for k, v in outside.items() if k not in ('is_fully_contained', 'overlaps')}
+
+
+def test_attr_getter():
+    from ..applications.exporters.json import attr_getter
+    coord = orm.Coordinate(seqid='a', length=3)
+    assert attr_getter(['seqid', 'length'])(coord) == ('a', 3)
+    # a tuple for a single key as well
+    assert attr_getter(['seqid'])(coord) == ('a',)
+    assert dict(zip(['length'], attr_getter(['length'])(coord))) == {'length': 3}
+
+
+@pytest.mark.parametrize('use_orjson', [False, True])
+def test_write_coordinate_range(use_orjson):
+    if use_orjson:
+        pytest.importorskip('orjson')
+    import io
+    controller = JsonExportController(db_path_in='sqlite:///' + EXPORTING_DB)
+    expect = controller.coordinate_range_to_json('dummy', 'Chr1:195000-199000', 1, 3900, True)
+    handle_out = io.BytesIO()
+    controller.write_coordinate_range(handle_out, 'dummy', 'Chr1:195000-199000', 1, 3900, True,
+                                      use_orjson=use_orjson)
+    assert json.loads(handle_out.getvalue()) == json.loads(expect)
+    if not use_orjson:
+        # byte for byte as json.dumps of the whole structure
+        assert handle_out.getvalue() == expect.encode()
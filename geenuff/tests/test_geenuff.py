@@ -1,4 +1,5 @@
 import os
+import gzip
 import pytest
 from sqlalchemy import create_engine
 from sqlalchemy import func
@@ -9,6 +10,7 @@ import sqlalchemy
 from .. import orm
 from .. import types
 from .. import helpers
+from ..base import gff, fasta
 from ..base.orm import (Genome, Feature, Coordinate, Transcript, TranscriptPiece, SuperLocus,
                         Protein)
 from ..base.handlers import SuperLocusHandlerBase, TranscriptHandlerBase
@@ -367,6 +369,131 @@ def test_fasta_import():
     assert coords[2].sequence == 'A' * 100
 
 
+def test_fasta_reader(tmp_path):
+    content = b'>a first\r\nacgt\r\nNNac\r\n>empty\n>b\nAC\nGT\n\n'
+    for opener, name in [(open, 'x.fa'), (gzip.open, 'x.fa.gz')]:
+        path = str(tmp_path / name)
+        with opener(path, 'wb') as f:
+            f.write(content)
+        # tiny blocks, so that lines and headers end up at and across block borders
+        for block_size in [1, 3, 7, 1000]:
+            records = []
+            for record in fasta.read_fasta(path, block_size=block_size):
+                records.append((record.header, record.read(), record.length, record.sha1))
+            assert records == [('a first', 'ACGTNNAC', 8, helpers.sequence_hash('ACGTNNAC')),
+                               ('empty', '', 0, helpers.sequence_hash('')),
+                               ('b', 'ACGT', 4, helpers.sequence_hash('ACGT'))]
+    # unread records are skipped
+    assert [r.header for r in fasta.read_fasta(path)] == ['a first', 'empty', 'b']
+    # and the gzipped fasta imports as any other
+    controller = ImportController(database_path='sqlite:///:memory:', sequence_storage=types.TWO_BIT,
+                                  chunk_size=3)
+    controller.add_sequences(path)
+    coords = controller.session.query(Coordinate).all()
+    assert [(c.seqid, c.length, c.get_sequence()) for c in coords] == [('a', 8, 'ACGTNNAC'),
+                                                                        ('empty', 0, ''),
+                                                                        ('b', 4, 'ACGT')]
+
+
+def test_sequence_deduplication(tmp_path, monkeypatch):
+    controller = ImportController(database_path='sqlite:///:memory:')
+    controller.add_sequences('testdata/basic_sequences.fa', genome_args={'species': 'a'})
+    # the same sequences under another name, plus a duplicate within the file
+    path = str(tmp_path / 'copy.fa')
+    with open('testdata/basic_sequences.fa') as f_in, open(path, 'w') as f_out:
+        f_out.write(f_in.read() + '>again\nATATATAT\n')
+    controller.add_sequences(path, genome_args={'species': 'b'})
+    first, second = [sorted(g.coordinates, key=lambda c: c.id)
+                     for g in controller.session.query(Genome).order_by(Genome.id).all()]
+    assert [c.sha1 for c in first] == [c.sha1 for c in second[:5]]
+    for coord in second:
+        assert coord.sequence is None
+        assert coord.sequence_source in first
+    assert second[1].get_sequence() == 'AAGGCCTT' * 101
+    assert second[5].get_slice(2, 5) == 'ATA'
+    assert second[5].sequence_source is first[3]
+
+    # unchanged files are not even read again, but still get their coordinates
+    def fail(*args, **kwargs):
+        raise AssertionError('file was read')
+    monkeypatch.setattr(fasta, 'read_fasta', fail)
+    controller.add_sequences(path, genome_args={'species': 'c'})
+    third = sorted(controller.session.query(Genome).filter(Genome.species == 'c').one().coordinates,
+                   key=lambda c: c.id)
+    assert [(c.seqid, c.length, c.sha1) for c in third] == [(c.seqid, c.length, c.sha1) for c in second]
+    assert third[5].get_sequence() == 'ATATATAT'
+    assert all(c.sequence_source in first for c in third)
+
+
+def test_chunked_sequence_storage():
+    plain = ImportController(database_path='sqlite:///:memory:')
+    plain.add_genome('testdata/dummyloci.fa', 'testdata/dummyloci.gff', clean_gff=True)
+    plain_coord = plain.session.query(Coordinate).first()
+    plain_seq = plain_coord.sequence
+    for storage_type in [types.ZLIB, types.TWO_BIT]:
+        controller = ImportController(database_path='sqlite:///:memory:', sequence_storage=storage_type,
+                                      chunk_size=100)
+        controller.add_genome('testdata/dummyloci.fa', 'testdata/dummyloci.gff', clean_gff=True)
+        coord = controller.session.query(Coordinate).first()
+        assert coord.sequence is None
+        assert coord.sequence_chunks.count() == -(-coord.length // 100)
+        assert coord.get_sequence() == plain_seq
+        # slices within, across and beyond chunk borders
+        ranges = [(0, 3), (95, 105), (150, 420), (coord.length - 5, coord.length + 10)]
+        for start, end in ranges:
+            assert coord.get_slice(start, end) == plain_seq[start:end]
+        assert coord.get_slices(ranges) == [plain_seq[start:end] for start, end in ranges]
+        # codon based error detection works just the same on the chunks
+        errors = [(f.start, f.end, f.type) for f in controller.session.query(Feature).all()
+                  if f.type.value in [types.MISSING_START_CODON, types.MISSING_STOP_CODON]]
+        plain_errors = [(f.start, f.end, f.type) for f in plain.session.query(Feature).all()
+                        if f.type.value in [types.MISSING_START_CODON, types.MISSING_STOP_CODON]]
+        assert sorted(errors) == sorted(plain_errors)
+
+
+def test_deferred_sequence():
+    controller = ImportController(database_path='sqlite:///:memory:')
+    controller.add_sequences('testdata/basic_sequences.fa')
+    controller.session.expire_all()
+    coords = controller.session.query(Coordinate).all()
+    # metadata only, the sequence is not loaded ...
+    assert coords[1].seqid == 'abc'
+    assert 'sequence' in sqlalchemy.inspect(coords[1]).unloaded
+    # ... not even for slicing, which happens in sql
+    assert coords[1].get_slice(6, 10) == 'TTAA'
+    assert coords[1].get_slice(800, 900) == 'AAGGCCTT'
+    assert coords[1].get_slices([(-2, 2), (6, 10), (7, 7), (800, 900)]) == ['AA', 'TTAA', '', 'AAGGCCTT']
+    assert 'sequence' in sqlalchemy.inspect(coords[1]).unloaded
+    # but still on access
+    assert coords[1].sequence == 'AAGGCCTT' * 101
+
+
+def test_codon_windows(monkeypatch):
+    from ..applications import importer
+    entries = list(gff.read_gff('testdata/dummyloci.gff'))
+    cds = [e for e in entries if e.type == 'CDS']
+    windows = importer.codon_windows([entries], 10 ** 6)
+    assert windows == sorted(windows)
+    assert all(windows[i][1] < windows[i + 1][0] for i in range(len(windows) - 1))
+    assert all(any(start <= e.start - 1 and e.start + 3 <= end for start, end in windows) for e in cds)
+    assert all(any(start <= e.end - 3 and e.end <= end for start, end in windows) for e in cds)
+    sequence = helpers.SequenceWindows([(0, 4), (10, 20)], ['ACGT', 'A' * 5 + 'C' * 5], 20)
+    assert sequence[-2:1] == 'A'
+    assert sequence[14:18] == 'ACCC'
+    assert sequence[18:25] == 'CC'
+    with pytest.raises(AssertionError):
+        sequence[3:11]
+
+    # the clean import only ever loads the sequence around the CDS ends
+    def fail(*args, **kwargs):
+        raise AssertionError('whole sequence loaded')
+    monkeypatch.setattr(Coordinate, 'get_sequence', fail)
+    for workers in [1, 2]:
+        controller = ImportController(database_path='sqlite:///:memory:', workers=workers)
+        controller.add_genome('testdata/dummyloci.fa', 'testdata/dummyloci.gff', clean_gff=True)
+        assert [f for f in controller.session.query(Feature).all() if f.type.value == types.MISSING_START_CODON]
+
+
 def test_import_multiple_genomes():
     controller = ImportController(database_path='sqlite:///:memory:')
     InsertCounterHolder.sync_counters_with_db(controller.session)
@@ -418,6 +545,67 @@ def test_import_multiple_genomes():
     assert len(proteins_sl_1) == len(proteins_sl_2) == len(proteins_sl_3)
 
 
+def test_parallel_import_matches_serial():
+    def feature_set(controller):
+        return {(f.type.value, f.start, f.end, f.is_plus_strand, f.given_name, f.coordinate.seqid,
+                 tuple(sorted(p.transcript.given_name for p in f.transcript_pieces)))
+                for f in controller.session.query(Feature).all()}
+
+    # the workers only get the sequence when cleaning
+    for fa, gff, clean in [('testdata/dummyloci.fa', 'testdata/dummyloci.gff', True),
+                           ('testdata/exonexonCDS.fa', 'testdata/exonexonCDS.gff3', False)]:
+        serial = ImportController(database_path='sqlite:///:memory:')
+        serial.add_genome(fa, gff, clean_gff=clean)
+        parallel = ImportController(database_path='sqlite:///:memory:', workers=2)
+        parallel.add_genome(fa, gff, clean_gff=clean)
+
+        assert feature_set(serial) == feature_set(parallel)
+        assert parallel.session.query(Transcript).count() == serial.session.query(Transcript).count()
+        assert parallel.session.query(Protein).count() == serial.session.query(Protein).count()
+
+
+def test_no_write_transaction_across_seqids(tmp_path, monkeypatch):
+    """the session reads each seqid's sequence on its own connection, so what was flushed for
+    the seqids before has to be committed, or a spilled write transaction would lock it out"""
+    from ..applications import importer
+    open_at_read = []
+    queue_entry_groups = importer.queue_entry_groups
+
+    def checked_queue_entry_groups(entry_groups, coord, controller, clean):
+        open_at_read.append(controller.insertion_queues.transaction is not None)
+        queue_entry_groups(entry_groups, coord, controller, clean)
+
+    monkeypatch.setattr(importer, 'queue_entry_groups', checked_queue_entry_groups)
+    controller = ImportController(database_path=str(tmp_path / 'seqids.sqlite3'), flush_at=1)
+    controller.add_genome('testdata/dummyloci.fa', 'testdata/dummyloci.gff', clean_gff=True)
+    assert len(open_at_read) > 1
+    assert not any(open_at_read)
+
+
+def test_fast_import():
+    db_path = 'testdata/fast_import.sqlite3'
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    reference = ImportController(database_path='sqlite:///:memory:')
+    reference.add_genome('testdata/dummyloci.fa', 'testdata/dummyloci.gff', clean_gff=True)
+
+    controller = ImportController(database_path=db_path, fast_import=True)
+    controller.add_genome('testdata/dummyloci.fa', 'testdata/dummyloci.gff', clean_gff=True)
+    inspector = sqlalchemy.inspect(controller.engine)
+    # secondary indexes are deferred ...
+    assert not inspector.get_indexes('feature')
+    assert (controller.session.execute('PRAGMA synchronous').fetchone()[0] == 0)
+    controller.finalize()
+    # ... and built at the end
+    inspector = sqlalchemy.inspect(controller.engine)
+    for table in orm.Base.metadata.sorted_tables:
+        expected = set([index.name for index in table.indexes])
+        assert set([index['name'] for index in inspector.get_indexes(table.name)]) == expected
+    assert controller.session.execute('PRAGMA journal_mode').fetchone()[0] == 'delete'
+    assert controller.session.query(Feature).count() == reference.session.query(Feature).count()
+    os.remove(db_path)
+
+
 def test_dummyloci_errors():
     """Tests if all errors generated for dummyloci{.gff|.fa} are correct"""
 
@@ -817,6 +1005,23 @@ def test_gff_gen():
     assert x[-1].type == 'CDS'
 
 
+def test_gff_reader(tmp_path):
+    entries = list(gff.read_gff('testdata/testerSl.gff3'))
+    cds = [e for e in entries if e.type == 'CDS'][0]
+    assert (cds.start, cds.end, cds.score, cds.strand, cds.phase) == (13024, 13103, None, '+', 0)
+    assert cds.get_ID() == 'cds0'
+    assert cds.get_Parent() == ['rna1']
+    assert cds.get_attribute('protein_id') == ['NP_001233827.1']
+    assert cds.get_attribute('nope') == []
+    # gzipped input, lines with trailing tabs and the end at a fasta section
+    gff_gz = str(tmp_path / 'tester.gff3.gz')
+    with open('testdata/dummyloci.gff', 'rb') as f_in, gzip.open(gff_gz, 'wb') as f_out:
+        f_out.write(f_in.read() + b'##FASTA\n>1\nACGT\n')
+    assert len(list(gff.read_gff(gff_gz))) == 78
+    with pytest.raises(ValueError):
+        gff.parse_line('1\tmanual\tgene\t1\t400\t.\t?\t.\tID=x')
+
+
 def test_gff_useful_gen():
     gff_organizer = OrganizedGFFEntries('testdata/testerSl.gff3')
     x = list(gff_organizer._useful_gff_entries())
@@ -835,6 +1040,16 @@ def test_gff_grouper():
             assert group[0].type == 'gene'
 
 
+def test_gff_grouper_streaming():
+    gff_organizer = OrganizedGFFEntries('testdata/testerSl.gff3')
+    streamed = list(gff_organizer.gen_organized_entries())
+    # one batch per seqid, in file order
+    assert [seqid for seqid, _ in streamed] == ['NC_015438.2', 'NC_015439.2', 'NC_015440.2']
+    assert [len(groups) for _, groups in streamed] == [2, 2, 1]
+    # and nothing is kept around on the organizer itself
+    assert gff_organizer.organized_entries == {}
+
+
 # section: types
 def test_enum_non_inheritance():
     allknowngff = [x.name for x in list(types.AllKnownGFFFeatures)]
@@ -850,6 +1065,18 @@ def test_enums_name_val_match():
         assert x.name == x.value
 
 
+def test_gff_type_categories():
+    # every known type has exactly one category
+    assert set(types.GFF_TYPE_CATEGORIES) == set(x.value for x in types.AllKnownGFFFeatures)
+    for x in types.SuperLocusAll:
+        assert types.GFF_TYPE_CATEGORIES[x.value] == types.GFF_SUPER_LOCUS
+    for x in types.TranscriptLevelAll:
+        assert types.GFF_TYPE_CATEGORIES[x.value] == types.GFF_TRANSCRIPT
+    assert types.GFF_TYPE_CATEGORIES['exon'] == types.GFF_EXON
+    assert types.GFF_TYPE_CATEGORIES['CDS'] == types.GFF_CDS
+    assert types.GFF_TYPE_CATEGORIES['region'] == types.GFF_IGNORABLE
+
+
 # section: helpers
 def test_key_matching():
     # identical
@@ -895,6 +1122,77 @@ def test_key_matching():
         print(mapper.key_vals)
 
 
+def test_incremental_key_matching():
+    # identical keys map to themselves
+    mapper = helpers.IncrementalKeyMapper({'a', 'b', 'c'})
+    assert mapper('a') == 'a'
+    with pytest.raises(helpers.NonMatchableIDs):
+        mapper('d')
+
+    # other is abbreviated from known, matched one key at a time
+    mapper = helpers.IncrementalKeyMapper({'a.seq', 'b.seq', 'c.seq'})
+    assert mapper('a') == 'a.seq'
+    assert mapper('c') == 'c.seq'
+    assert mapper.key_vals == {'a': 'a.seq', 'c': 'c.seq'}
+    # two keys may not share a match
+    with pytest.raises(helpers.NonMatchableIDs):
+        mapper('a.s')
+
+    # cannot be safely differentiated
+    mapper = helpers.IncrementalKeyMapper({'ab.seq', 'ba.seq', 'c.seq', 'a.seq', 'b.seq'})
+    assert mapper('c') == 'c.seq'
+    with pytest.raises(helpers.NonMatchableIDs):
+        mapper('a')
+
+
+def test_counter_reserve():
+    counter = helpers.Counter(at=3)
+    assert counter() == 4
+    assert counter.reserve(10) == (4, 14)
+    assert counter() == 15
+    counter.move_to(4)
+    assert [counter() for _ in range(10)][-1] == counter.at == 14
+
+
+def test_queue_controller_flush_threshold():
+    sess = mk_memory_session()
+    qc = helpers.QueueController(sess, sess.get_bind(), flush_at=2)
+    queue = helpers.CoreQueue(orm.Genome.__table__.insert())
+    qc.ordered_queues = [queue]
+    queue.queue += [{'id': i, 'species': str(i)} for i in range(1, 6)]
+    # over the threshold, so everything is written in chunks of two
+    qc.flush_if_full()
+    assert not queue.queue
+    assert queue.rows_written == 5
+    # below threshold, nothing is written
+    queue.queue.append({'id': 6, 'species': '6'})
+    qc.flush_if_full()
+    assert len(queue.queue) == 1
+    qc.execute_so_far()
+    assert sess.query(Genome).count() == 6
+    assert qc.transaction is None
+
+
 def test_gff_to_seqids():
     x = helpers.get_seqids_from_gff('testdata/testerSl.gff3')
     assert x == {'NC_015438.2', 'NC_015439.2', 'NC_015440.2'}
+
+
+def test_reverse_complement():
+    assert helpers.reverse_complement('AACGTNMRW') == 'WYKNACGTT'
+    assert helpers.reverse_complement(b'AACGTN') == b'NACGTT'
+    assert helpers.reverse_complement('') == ''
+    for seq in ['ACXGT', b'ACXGT', 'acgt']:
+        with pytest.raises(KeyError):
+            helpers.reverse_complement(seq)
+
+
+def test_interval_arithmetic():
+    from ..base import intervals
+    # groups 0 and 1 at overlapping positions must not interact
+    keep = [(0, 0, 100), (1, 0, 100), (0, 200, 210), (0, 20, 25)]
+    other = [(0, 10, 20), (0, 15, 30), (0, 90, 205), (1, 50, 60), (1, 60, 70), (2, 0, 300)]
+    subtracted = list(intervals.subtract(keep, other))
+    assert subtracted == [(0, 0, 0, 10), (0, 0, 30, 90), (1, 1, 0, 50), (1, 1, 70, 100), (2, 0, 205, 210)]
+    # nothing to subtract leaves everything
+    assert list(intervals.subtract(keep, [])) == [(i,) + k for i, k in enumerate(keep)]
@@ -5,7 +5,7 @@ import logging
 import argparse
 
 from geenuff.applications.importer import ImportController
-from geenuff.base import orm
+from geenuff.base import orm, types, storage
 
 
 class PathFinder(object):
@@ -66,11 +66,15 @@ def main(args):
     # log to file and stderr simultaneously
     logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
 
-    controller = ImportController(database_path=paths.db_out, replace_db=args.replace_db)
+    controller = ImportController(database_path=paths.db_out, replace_db=args.replace_db,
+                                  workers=args.workers, flush_at=args.flush_at,
+                                  fast_import=args.fast_import, sequence_storage=args.sequence_storage,
+                                  chunk_size=args.chunk_size)
     genome_args = {}
     for key in ['species', 'accession', 'version', 'acquired_from']:
         genome_args[key] = vars(args)[key]
     controller.add_genome(paths.fasta_in, paths.gff_in, genome_args)
+    controller.finalize()
 
 
 if __name__ == '__main__':
@@ -87,6 +91,21 @@ if __name__ == '__main__':
     parser.add_argument('--replace-db', action='store_true',
                         help=('whether to override a GeenuFF database found at '
                               'the default location or at the location of --db_path'))
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes used to parse and error check the gff, one seqid '
+                             'at a time (default 1)')
+    parser.add_argument('--flush-at', type=int, default=10000,
+                        help='write the queued rows to the database as soon as one table has this '
+                             'many of them (default 10000)')
+    parser.add_argument('--fast-import', action='store_true',
+                        help='import without journaling/syncing and build the indexes only at the end, '
+                             'an interrupted import may leave a corrupt database')
+    parser.add_argument('--sequence-storage', default=types.PLAIN, choices=[x.value for x in types.SequenceStorage],
+                        help='store each sequence as one plain string, or in compressed chunks that can be '
+                             'sliced without loading the whole sequence (default plain)')
+    parser.add_argument('--chunk-size', type=int, default=storage.DEFAULT_CHUNK_SIZE,
+                        help='number of bases per compressed sequence chunk (default {})'.format(
+                            storage.DEFAULT_CHUNK_SIZE))
 
     genome_attr = parser.add_argument_group('Possible genome attributes:')
     genome_attr.add_argument('--species', required=True, help='name of the species')
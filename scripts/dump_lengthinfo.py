@@ -1,21 +1,22 @@
 #! /usr/bin/env python3
 import argparse
 
-from geenuff.applications.exporters.lengths import LengthExportController
+from geenuff.applications.exporters.lengths import LengthExportController, parse_x_grid
 from geenuff.applications.exporter import MODES
 
 
 def main(args):
     controller = LengthExportController(args.db_path_in, args.longest)
-    if args.mode in MODES:
-        controller.prep_ranges(args.genomes, args.exclude_genomes,
-                               MODES[args.mode])
-    else:
+    if args.mode not in MODES:
         raise NotImplementedError("Requested mode ({}) not in implemented types {}".format(args.mode,
                                                                                            list(MODES.keys())))
     if args.stats_only:
-        controller.write_length_stats(args.out)
+        controller.stream_length_stats(args.genomes, args.exclude_genomes, args.mode, args.out,
+                                       by_genome=args.by_genome,
+                                       quantile_x=parse_x_grid(args.quantiles),
+                                       nx_x=parse_x_grid(args.nx))
     else:
+        controller.prep_lengths(args.genomes, args.exclude_genomes, args.mode)
         controller.write_lengths(args.out)
 
 
@@ -38,6 +39,14 @@ if __name__ == "__main__":
                         help="ignore all but the longest transcript per gene")
     parser.add_argument('--stats_only', action="store_true",
                         help="output summary statistics about the lengths instead of the lengths themselves")
+    parser.add_argument('--by-genome', action="store_true",
+                        help="with --stats_only, output the summary statistics for each genome separately")
+    parser.add_argument('--quantiles', type=str, default='10,25,50,75,90',
+                        help="with --stats_only, the quantiles to output as comma separated percentages "
+                             "and/or ranges such as 1-99 (default 10,25,50,75,90)")
+    parser.add_argument('--nx', type=str, default='10,25,50,75,90',
+                        help="with --stats_only, the N-values to output, same format as --quantiles "
+                             "(default 10,25,50,75,90), e.g. 1-99 for a full Nx curve")
     args = parser.parse_args()
 
     main(args)
@@ -6,16 +6,15 @@ from geenuff.applications.exporter import MODES
 
 
 def main(args):
-    controller = FastaExportController(args.db_path_in, args.longest)
+    controller = FastaExportController(args.db_path_in, args.longest,
+                                       sequence_cache_bytes=args.sequence_cache_mb * 2 ** 20)
     if args.mode in MODES:
-        controller.prep_ranges(args.genomes, args.exclude_genomes,
-                               MODES[args.mode])
+        controller.stream_fa(args.genomes, args.exclude_genomes, MODES[args.mode], args.out)
     else:
         raise NotImplementedError("Requested mode ({}) not in implemented types {}".format(args.mode,
                                                                                            list(MODES.keys())))
     #coords_ids = controller._get_coords_by_genome_query(args.genomes, args.exclude_genomes)
     #x = controller.get_super_loci_by_coords(coords_ids)
-    controller.write_fa(args.out)
 
 
 if __name__ == "__main__":
@@ -36,6 +35,8 @@ if __name__ == "__main__":
 
     parser.add_argument('-l', '--longest', action="store_true",
                         help="ignore all but the longest transcript per gene")
+    parser.add_argument('--sequence-cache-mb', type=int, default=1024,
+                        help='maximum size of the decoded sequences kept in memory (default 1024)')
     args = parser.parse_args()
 
     main(args)
@@ -0,0 +1,32 @@
+#! /usr/bin/env python3
+import argparse
+import logging
+
+from geenuff.applications.region_server import make_server, DEFAULT_SUPER_LOCUS_CACHE_SIZE
+
+
+def main(args):
+    server = make_server(args.db_path_in, args.host, args.port, args.cache_size)
+    logging.info('serving regions of {} on {}:{}'.format(args.db_path_in, *server.server_address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Serves GET /region/<species>/<seqid>/<start>/<end>/<+|-> as json, '
+                    'and timing metrics at GET /metrics')
+    parser.add_argument('--db-path-in', type=str, required=True,
+                        help='Path to the Geenuff SQLite input database.')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_SUPER_LOCUS_CACHE_SIZE,
+                        help='number of super loci kept loaded and serialized in memory (default {})'.format(
+                            DEFAULT_SUPER_LOCUS_CACHE_SIZE))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    main(args)
@@ -0,0 +1,38 @@
+#! /usr/bin/env python3
+import argparse
+import logging
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+
+from geenuff.base import orm
+from geenuff.base.helpers import full_db_path
+
+
+def main(args):
+    engine = create_engine(full_db_path(args.db_path), echo=False)
+    start = time.time()
+    orm.upgrade_schema(engine)
+    try:
+        with engine.begin() as conn:
+            if not orm.has_feature_rtree(conn):
+                orm.create_feature_rtree(conn)
+                orm.fill_feature_rtree(conn)
+    except OperationalError as e:
+        # e.g. sqlite without the R*Tree module, region exports then scan the coordinates
+        logging.warning('could not build the feature index: {}'.format(e))
+    logging.info('upgraded {} in {:.2f}s'.format(args.db_path, time.time() - start))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Adds the tables, columns and indexes (including the feature '
+                                                 'index) of the current schema to a Geenuff database made by '
+                                                 'an earlier version. Exports read such databases as they '
+                                                 'are, but slower without the indexes.')
+    parser.add_argument('--db-path', type=str, required=True,
+                        help='Path to the Geenuff SQLite database to upgrade (in place).')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    main(args)